@@ -19,3 +19,4 @@ from arbiter.eventnode import EventNode, RedisEventNode, MockEventNode
 from arbiter.rpcnode import RpcNode
 from arbiter.rpcclient import RPCClient
 from arbiter.task import Task
+from arbiter.result import AsyncResult, ResultSet
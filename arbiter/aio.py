@@ -0,0 +1,583 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    asyncio flavour of Arbiter and Minion
+
+    Both run on a single pika AsyncioConnection inside the running event loop and speak
+    the same wire protocol as Arbiter and Minion, so they can be mixed with them
+"""
+
+import asyncio
+import inspect
+import logging
+import threading
+import functools
+from time import time
+from uuid import uuid4
+from traceback import format_exc
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from arbiter.base import Base
+from arbiter.codec import codec_for, properties_for
+from arbiter.config import Config
+from arbiter.event.arbiter import apply_event
+from arbiter.executor import map_chunk
+from arbiter.registry import WorkerRegistry, capacity_message, change_active_workers
+from arbiter.result import ResultRegistry
+from arbiter.state import MemoryStateStore
+from arbiter.task import Task
+
+
+class AsyncBase:
+    def __init__(self, host, port, user, password, vhost="carrier", queue=None, all_queue="arbiterAll", wait_time=2.0,
+                 use_ssl=False, ssl_verify=False, codec=None, max_priority=None):
+        self.config = Config(host, port, user, password, vhost, queue, all_queue, use_ssl, ssl_verify, codec,
+                             max_priority=max_priority)
+        self.wait_time = wait_time
+        self.loop = None
+        self.connection = None
+        self.channel = None
+        self.closing = False
+        self.closed = None
+        self._waiting = set()
+        self._background = set()
+
+    _get_parameters = Base._get_parameters
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.closing = False
+        self.closed = self.loop.create_future()
+        opened = self.loop.create_future()
+        self.connection = AsyncioConnection(
+            self._get_parameters(),
+            on_open_callback=lambda connection: self._set_result(opened, connection),
+            on_open_error_callback=lambda _, error: self._set_exception(opened, pika.exceptions.AMQPConnectionError(error)),
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.loop,
+        )
+        await opened
+        self.channel = await self._call(self.connection.channel, callback_name="on_open_callback")
+        self.channel.add_on_close_callback(self._on_channel_closed)
+        if self.config.queue:
+            await self._call(self.channel.queue_declare, queue=self.config.queue, durable=True,
+                             arguments=self.config.queue_arguments)
+        await self._call(self.channel.exchange_declare, exchange=self.config.all, exchange_type="fanout", durable=True)
+        return self
+
+    async def close(self):
+        if self.connection is None or self.connection.is_closed:
+            return
+        self.closing = True
+        if not self.connection.is_closing:
+            self.connection.close()
+        await asyncio.shield(self.closed)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    async def _call(self, method, *args, callback_name="callback", **kwargs):
+        """ Await pika method reporting completion to a callback """
+        future = self.loop.create_future()
+        self._waiting.add(future)
+        try:
+            method(*args, **{callback_name: lambda result: self._set_result(future, result)}, **kwargs)
+            return await future
+        finally:
+            self._waiting.discard(future)
+
+    def _spawn(self, coro):
+        """ Background task, kept referenced till done as the loop holds tasks weakly """
+        task = self.loop.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, exception):
+        if not future.done():
+            future.set_exception(exception)
+
+    def _on_channel_closed(self, channel, reason):
+        _ = channel
+        for future in list(self._waiting):
+            self._set_exception(future, pika.exceptions.ChannelClosed(0, str(reason)))
+        if not self.closing:
+            logging.warning("[Async] Channel closed: %s", reason)
+            self.connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        _ = connection
+        for future in list(self._waiting):
+            self._set_exception(future, pika.exceptions.ConnectionClosed(0, str(reason)))
+        if self.closing:
+            self._set_result(self.closed, None)
+        else:
+            logging.warning("[Async] Connection closed: %s", reason)
+            self._set_exception(self.closed, pika.exceptions.AMQPConnectionError(reason))
+
+    def send_message(self, msg, reply_to="", queue="", exchange="", codec=None, priority=None):
+        codec = codec if codec is not None else self.config.codec
+        self.channel.basic_publish(
+            exchange=exchange, routing_key=queue,
+            body=codec.encode(msg),
+            properties=pika.BasicProperties(**properties_for(
+                codec,
+                reply_to=reply_to,
+                delivery_mode=2,
+                priority=priority
+            ))
+        )
+
+
+class AsyncArbiter(AsyncBase):
+    """
+    Arbiter with awaitable API
+
+        async with AsyncArbiter(host, port, user, password) as arbiter:
+            task_keys = await arbiter.apply("simple_add", task_args=[1, 2])
+            result = await arbiter.get(task_keys[0])
+    """
+
+    def __init__(self, host, port, user, password, vhost="carrier", all_queue="arbiterAll", wait_time=2.0,
+                 use_ssl=False, ssl_verify=False, codec=None, state_store=None):
+        super().__init__(host, port, user, password, vhost, all_queue=all_queue, wait_time=wait_time,
+                         use_ssl=use_ssl, ssl_verify=ssl_verify, codec=codec)
+        self.arbiter_id = str(uuid4())
+        self.state = state_store if state_store is not None else MemoryStateStore()
+        self.results = ResultRegistry()
+        self.state.on_evict.append(self.results.forget)
+        self.registry = WorkerRegistry()
+        self.followers = dict()  # task key -> group callback/finalizer waiting for its group
+
+    async def connect(self):
+        await super().connect()
+        await self._call(self.channel.queue_declare, queue=self.arbiter_id, durable=True)
+        await self._call(self.channel.basic_consume, self.arbiter_id, self._on_event)
+        await self._call(self.channel.exchange_declare, exchange=self.config.heartbeat,
+                         exchange_type="fanout", durable=True)
+        heartbeat_queue = await self._call(self.channel.queue_declare, queue="", exclusive=True)
+        await self._call(self.channel.queue_bind, heartbeat_queue.method.queue, self.config.heartbeat)
+        await self._call(self.channel.basic_consume, heartbeat_queue.method.queue, self._on_heartbeat, auto_ack=True)
+        self._request_state()
+        return self
+
+    async def close(self):
+        for task in list(self._background):
+            task.cancel()
+        if self.channel is not None and self.channel.is_open:
+            await self._call(self.channel.queue_delete, queue=self.arbiter_id)
+        await super().close()
+
+    def _on_event(self, channel, method, properties, body):
+        try:
+            event = codec_for(properties, self.config.codec).decode(body)
+            logging.info("[AsyncArbiter] Type: %s", event.get("type"))
+            apply_event(event, self.state, self.results, self.registry)
+        except:  # pylint: disable=W0702
+            logging.exception("[AsyncArbiter] Got exception")
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _on_heartbeat(self, channel, method, properties, body):
+        _ = channel, method
+        try:
+            self.registry.update(codec_for(properties, self.config.codec).decode(body))
+        except:  # pylint: disable=W0702
+            logging.exception("[AsyncArbiter] [Heartbeat] Got exception")
+
+    def _request_state(self):
+        self.registry.legacy.clear()
+        self.send_message({"type": "state", "arbiter": self.arbiter_id}, exchange=self.config.all)
+
+    def add_task(self, task):
+        """ Publish task copies, returns their keys; publishing does not block the loop """
+        task.callback_queue = self.arbiter_id
+        message = task.to_json()
+        tasks = []
+        for _ in range(task.tasks_count):
+            task_key = str(uuid4()) if task.task_key == "" else task.task_key
+            tasks.append(task_key)
+            if task_key not in self.state:
+                self.results.register(task_key, self.state.add_task(task_key, task.task_type))
+            message["task_key"] = task_key
+            self.send_message(message, reply_to=task.callback_queue, queue=task.queue, priority=task.priority)
+        return tasks
+
+    async def apply(self, task_name, queue="default", tasks_count=1, task_args=None, task_kwargs=None, priority=None):
+        task = Task(name=task_name, queue=queue, tasks_count=tasks_count, task_args=task_args, task_kwargs=task_kwargs,
+                    priority=priority)
+        return self.add_task(task)
+
+    async def wait(self, task_key, timeout=None):
+        """ Wait till task is done, returns its AsyncResult handle """
+        handle = self.results.get(task_key)
+        if handle is None:
+            raise NameError("Task not found")
+        if not handle.ready():
+            future = self.loop.create_future()
+            # handles are resolved by _on_event, i.e. in the loop thread
+            handle.add_done_callback(lambda _: self._set_result(future, None))
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Task {task_key} is not done after {timeout} sec")
+        return handle
+
+    async def get(self, task_key, timeout=None):
+        """ Task result, raises ChildProcessError if task failed """
+        handle = await self.wait(task_key, timeout)
+        return handle.get(0)
+
+    async def wait_for_tasks(self, tasks, timeout=None):
+        """ Task states as they are done """
+        for future in asyncio.as_completed([self.wait(task_key) for task_key in tasks], timeout=timeout):
+            handle = await future
+            yield dict(handle.state)
+
+    async def kill(self, task_key, timeout=None):
+        """ Stop the task, returns True once minion confirmed it """
+        self.results.register(task_key, self.state.get(task_key))
+        if self._cancel_follower(task_key):
+            return True
+        self.send_message({"type": "stop_task", "task_key": task_key, "arbiter": self.arbiter_id},
+                          exchange=self.config.all)
+        try:
+            await self.wait(task_key, timeout)
+        except TimeoutError:
+            logging.warning("Task was not confirmed as stopped in %s sec: %s", timeout, task_key)
+            return False
+        return True
+
+    async def kill_group(self, group_id, timeout=None):
+        members = [task_key for task_key in self.state.group_members(group_id) if task_key in self.state]
+        # followers first, so killed callback does not release finalizer
+        members = [task_key for task_key in members if not self._cancel_follower(task_key)]
+        return all(await asyncio.gather(*[self.kill(task_key, timeout) for task_key in members]))
+
+    def _cancel_follower(self, task_key):
+        if self.followers.pop(task_key, None) is None:
+            return False
+        # not dispatched yet, nothing to stop on minions
+        self.results.resolve(task_key, self.state.update_task(task_key, "done", "canceled"))
+        return True
+
+    def status(self, task_key):
+        record = self.state.get(task_key)
+        if record is not None:
+            return dict(record)
+        elif self.state.has_group(task_key):
+            return self.state.group_status(task_key)
+        else:
+            raise NameError("Task or Group not found")
+
+    def group_tasks(self, group_id, offset=0, limit=100):
+        if not self.state.has_group(group_id):
+            raise NameError("Group not found")
+        return [dict(record, task_key=task_key)
+                for task_key, record in self.state.group_tasks(group_id, offset, limit)]
+
+    def forget(self, task_key):
+        if not self.state.forget(task_key):
+            raise NameError("Task or Group not found")
+
+    def stats(self):
+        return self.state.stats()
+
+    async def workers(self):
+        workers = self.registry.workers()
+        if workers:
+            return workers
+        self._request_state()
+        await asyncio.sleep(self.wait_time)
+        return self.registry.workers() or dict(self.registry.legacy)
+
+    async def squad(self, tasks, callback=None, priority=None):
+        workers_count = {}
+        for each in tasks:
+            if each.task_type != "finalize":
+                workers_count[each.queue] = workers_count.get(each.queue, 0) + each.tasks_count
+        stats = await self.workers()
+        for key in workers_count.keys():
+            if not stats.get(key) or stats[key]["available"] < workers_count[key]:
+                raise NameError(f"Not enough of {key} workers")
+        return await self.group(tasks, callback, priority)
+
+    async def group(self, tasks, callback=None, priority=None):
+        """
+        Set of tasks that need to be executed regardless of order
+        Callback and finalizer are dispatched by arbiter itself once all tasks are done
+        """
+        group_id = str(uuid4())
+        self.state.add_group(group_id)
+        finalizer = None
+        task_keys = []
+        for each in list(tasks) + ([callback] if callback else []):
+            if each.priority is None:
+                each.priority = priority
+        for each in tasks:
+            if each.task_type == "finalize":
+                finalizer = each
+                continue
+            each.task_key = ""  # every copy gets own key
+            for task_key in self.add_task(each):
+                task_keys.append(task_key)
+                self.state.add_to_group(group_id, task_key)
+        if callback or finalizer:
+            for each, task_type in [(callback, "callback"), (finalizer, "finalize")]:
+                if each:
+                    self._register_follower(group_id, each, task_type)
+            self._spawn(self._fan_in(group_id, task_keys, callback, finalizer))
+        else:
+            self.state.seal_group(group_id)
+        return group_id
+
+    async def _fan_in(self, group_id, task_keys, callback, finalizer):
+        try:
+            if callback:
+                await asyncio.gather(*[self.wait(task_key) for task_key in task_keys])
+                self._dispatch_follower(callback)
+                task_keys = [callback.task_key]
+            if finalizer:
+                timeout = None
+                if finalizer.timeout != -1:
+                    timeout = max(finalizer.start_time + finalizer.timeout - time(), 0)
+                try:
+                    await asyncio.wait_for(asyncio.gather(*[self.wait(task_key) for task_key in task_keys]), timeout)
+                except asyncio.TimeoutError:
+                    logging.info("Finalizer timeout: %s sec", finalizer.timeout)
+                self._dispatch_follower(finalizer)
+        finally:
+            self.state.seal_group(group_id)
+
+    def _register_follower(self, group_id, task, task_type):
+        """ Follower gets its key up front, so it is a group member kill_group can cancel before dispatch """
+        task.task_key = str(uuid4())
+        task.task_type = "task"
+        task.tasks_count = 1
+        self.results.register(task.task_key, self.state.add_task(task.task_key, task_type))
+        self.state.add_to_group(group_id, task.task_key)
+        self.followers[task.task_key] = task
+
+    def _dispatch_follower(self, task):
+        if self.followers.pop(task.task_key, None) is None:
+            return  # killed before its group was done
+        self.add_task(task)
+
+    async def pipe(self, tasks, persistent_args=None, persistent_kwargs=None):
+        """
+        Set of tasks that need to be executed sequentially
+        NOTE: Persistent args always before the task args
+              Task itself need to have **kwargs if you want to ignore upstream results
+        """
+        pipe_id = str(uuid4())
+        self.state.add_group(pipe_id)
+        persistent_args = persistent_args or []
+        persistent_kwargs = persistent_kwargs or {}
+        res = {}
+        yield {"pipe_id": pipe_id}
+        try:
+            for task in tasks:
+                task.task_args = persistent_args + task.task_args
+                for key, value in persistent_kwargs.items():
+                    if key not in task.task_kwargs:
+                        task.task_kwargs[key] = value
+                if res:
+                    task.task_kwargs["upstream"] = res.get("result")
+                task_key = self.add_task(task)[0]
+                self.state.add_to_group(pipe_id, task_key)
+                res = dict((await self.wait(task_key)).state)
+                yield res
+        finally:
+            self.state.seal_group(pipe_id)
+
+
+class AsyncMinion(AsyncBase):
+    """
+    Minion running tasks on the event loop
+
+    `async def` tasks run as asyncio tasks, plain functions in the default loop executor;
+    at most `concurrency` tasks run at once (broker prefetch)
+    """
+
+    def __init__(self, host, port, user, password, vhost="carrier", queue="default", all_queue="arbiterAll",
+                 use_ssl=False, ssl_verify=False, codec=None, max_priority=None):
+        super().__init__(host, port, user, password, vhost, queue, all_queue, use_ssl=use_ssl, ssl_verify=ssl_verify,
+                         codec=codec, max_priority=max_priority)
+        self.task_registry = {}
+        self.state = dict()
+
+    def task(self, name=None):
+        """ Task decorator """
+        def inner_task(func):
+            if not callable(func):
+                raise TypeError('@task decorated function must be callable')
+            task_name = name if name else f"{func.__name__}.{func.__module__}"
+            if task_name not in self.task_registry:
+                self.task_registry[task_name] = func
+            return self.task_registry[task_name]
+        return inner_task
+
+    async def run(self, concurrency=100, heartbeat_interval=2.0):
+        """ Consume tasks till close() is called, raises if connection is lost """
+        self.state.update({
+            "queue": self.config.queue,
+            "minion_id": str(uuid4()),
+            "total_workers": concurrency,
+            "active_workers": 0,
+            "seq": 0,
+            "heartbeat_interval": heartbeat_interval,
+            "lock": threading.Lock(),
+        })
+        await self.connect()
+        await self._call(self.channel.basic_qos, prefetch_count=concurrency)
+        await self._call(self.channel.basic_consume, self.config.queue, self._on_task)
+        global_queue = await self._call(self.channel.queue_declare, queue="", exclusive=True)
+        await self._call(self.channel.queue_bind, global_queue.method.queue, self.config.all)
+        await self._call(self.channel.basic_consume, global_queue.method.queue, self._on_global, auto_ack=True)
+        await self._call(self.channel.exchange_declare, exchange=self.config.heartbeat,
+                         exchange_type="fanout", durable=True)
+        self._heartbeat()
+        logging.info("[AsyncMinion] Waiting for task events")
+        await self.closed
+
+    def _heartbeat(self):
+        if self.channel is None or not self.channel.is_open:
+            return
+        self.send_message(capacity_message(self.state), exchange=self.config.heartbeat)
+        self.loop.call_later(self.state["heartbeat_interval"], self._heartbeat)
+
+    def _on_task(self, channel, method, properties, body):
+        _ = channel
+        codec = codec_for(properties, self.config.codec)
+        self._spawn(self._execute(codec.decode(body), codec, method.delivery_tag))
+
+    async def _execute(self, event, codec, delivery_tag):
+        if not event.get("task_key"):
+            event["task_key"] = str(uuid4())
+        task_key = event["task_key"]
+        change_active_workers(self.state, 1)
+        try:
+            if event.get("type", "task") != "task":
+                raise NotImplementedError(f"'{event.get('type')}' events are not supported by AsyncMinion")
+            if event.get("arbiter"):
+                self.send_message({"type": "task_state_change", "task_key": task_key, "task_state": "running"},
+                                  queue=event.get("arbiter"), codec=codec)
+            func = self.task_registry.get(event.get("task_name"))
+            if func is None:
+                raise ModuleNotFoundError("Task is not a part of this worker")
+            if event.get("map") and inspect.iscoroutinefunction(func):
+                process = asyncio.gather(*[func(item, **event.get("kwargs", {})) for item in event.get("args", [])])
+            elif event.get("map"):
+                process = self.loop.run_in_executor(
+                    None, functools.partial(map_chunk, func, *event.get("args", []), **event.get("kwargs", {}))
+                )
+            elif inspect.iscoroutinefunction(func):
+                process = self.loop.create_task(func(*event.get("args", []), **event.get("kwargs", {})))
+            else:
+                process = self.loop.run_in_executor(
+                    None, functools.partial(func, *event.get("args", []), **event.get("kwargs", {}))
+                )
+            self.state[task_key] = {"process": process, "status": "running"}
+            try:
+                result = await process
+            except asyncio.CancelledError:
+                if not process.cancelled():
+                    raise
+                result = "canceled"
+            task_state = "done"
+        except asyncio.CancelledError:
+            raise
+        except:  # pylint: disable=W0702
+            logging.exception("[AsyncMinion] Got exception")
+            result = format_exc()
+            task_state = "exception"
+        if task_key in self.state:
+            self.state[task_key]["status"] = "done"
+        change_active_workers(self.state, -1)
+        if self.channel is None or not self.channel.is_open:
+            return
+        forwarded = False
+        if event.get("chain") and task_state == "done" and not process.cancelled():
+            try:
+                # next stage of chained pipe gets the result as upstream kwarg
+                stage = dict(event["chain"][0], chain=event["chain"][1:])
+                stage["kwargs"] = dict(stage.get("kwargs") or {}, upstream=result)
+                self.send_message(stage, queue=stage.get("queue"), codec=codec, priority=stage.get("priority"))
+                forwarded = True
+            except:  # pylint: disable=W0702
+                logging.exception("[AsyncMinion] Failed to forward result")
+                result = format_exc()
+                task_state = "exception"
+        try:
+            if event.get("arbiter"):
+                message = {"type": "task_state_change", "task_key": task_key, "task_state": task_state,
+                           "capacity": capacity_message(self.state)}
+                if not forwarded:
+                    message["result"] = result
+                self.send_message(message, queue=event.get("arbiter"), codec=codec)
+        except:  # pylint: disable=W0702
+            # e.g. result the codec can not encode, arbiter still has to learn the task is over
+            logging.exception("[AsyncMinion] Failed to report task %s", task_key)
+            self._report_exception(event, codec, format_exc())
+        finally:
+            if not event.get("callback", False):
+                self.state.pop(task_key, None)
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _report_exception(self, event, codec, error):
+        try:
+            self.send_message({"type": "task_state_change", "task_key": event["task_key"], "task_state": "exception",
+                               "result": error, "capacity": capacity_message(self.state)},
+                              queue=event.get("arbiter"), codec=codec)
+        except:  # pylint: disable=W0702
+            logging.exception("[AsyncMinion] Failed to report task %s", event["task_key"])
+
+    def _on_global(self, channel, method, properties, body):
+        _ = channel, method
+        try:
+            codec = codec_for(properties, self.config.codec)
+            event = codec.decode(body)
+            event_type = event.get("type", None)
+            logging.info("[AsyncMinion] [GlobalEvent] Type: %s", event_type)
+            if event_type in ["stop_task", "purge_task"]:
+                task_key = event.get("task_key")
+                if task_key in self.state and not self.state[task_key]["process"].done():
+                    logging.info("[AsyncMinion] Cancelling task %s", task_key)
+                    self.state[task_key]["process"].cancel()
+            elif event_type == "state":
+                self.send_message(capacity_message(self.state, "state"), queue=event["arbiter"], codec=codec)
+            elif event_type == "task_state":
+                response = {"type": "task_state", "minion_id": self.state["minion_id"]}
+                if event.get("request_id"):
+                    response["request_id"] = event["request_id"]
+                for each in event.get("tasks", []):
+                    if each in self.state:
+                        response[each] = self.state[each]["status"] != "done"
+                self.send_message(response, queue=event["arbiter"], codec=codec)
+            elif event_type == "clear_state":
+                for task in event.get("tasks", []):
+                    self.state.pop(task, None)
+        except:  # pylint: disable=W0702
+            logging.exception("[AsyncMinion] [GlobalEvent] Got exception")
@@ -13,102 +13,257 @@
 #   limitations under the License.
 
 
+import queue
 import logging
+import threading
+from collections import deque
+from itertools import islice
 from uuid import uuid4
-from time import sleep
+from traceback import format_exc
+from time import sleep, time
+from datetime import datetime
 
 from .base import Base
 from .event.arbiter import ArbiterEventHandler
+from .registry import WorkerRegistry
+from .result import ResultSet, STREAM_END, STREAM_WINDOW
 from .task import Task
 
 
 class Arbiter(Base):
-    def __init__(self, host, port, user, password, timeout=0, vhost="carrier", all_queue="arbiterAll", start_consumer=True, use_ssl=False, ssl_verify=False):
-        super().__init__(host, port, user, password, vhost, all_queue=all_queue, use_ssl=use_ssl, ssl_verify=ssl_verify)
+    def __init__(self, host, port, user, password, timeout=0, vhost="carrier", all_queue="arbiterAll", start_consumer=True, use_ssl=False, ssl_verify=False, pool_size=4, confirm=False, state_store=None, codec=None,
+                 blob_store=None, blob_threshold=1024 * 1024):
+        super().__init__(host, port, user, password, vhost, all_queue=all_queue, use_ssl=use_ssl, ssl_verify=ssl_verify,
+                         pool_size=pool_size, confirm=confirm, state_store=state_store, codec=codec,
+                         blob_store=blob_store, blob_threshold=blob_threshold)
         self.arbiter_id = None
-        self.state = dict(groups=dict())
         self.subscriptions = dict()
+        self.registry = WorkerRegistry()
+        self.followers = dict()  # task key -> group callback/finalizer waiting for its group
+        self.deadlines = dict()  # task key -> timer dispatching finalizer on its timeout
         self.handler = None
         if start_consumer:
             self.arbiter_id = str(uuid4())
-            self.handler = ArbiterEventHandler(self.config, self.subscriptions, self.state, self.arbiter_id)
+            self.handler = ArbiterEventHandler(self.config, self.subscriptions, self.state, self.arbiter_id,
+                                               self.results, self.registry)
             self.handler.start()
             self.handler.wait_running(timeout=timeout)
+            self._request_state()
 
-    def apply(self, task_name, queue="default", tasks_count=1, task_args=None, task_kwargs=None, sync=False):
+    def apply(self, task_name, queue="default", tasks_count=1, task_args=None, task_kwargs=None, sync=False,
+              stream=False, priority=None, countdown=None, eta=None):
+        """
+        Start task copies, returns their keys
+        With stream=True (or window size) chunks of generator task are read with stream()
+        countdown (sec) or eta (datetime or timestamp) postpone delivery of the task to minions
+        """
+        if eta is not None:
+            countdown = (eta.timestamp() if isinstance(eta, datetime) else eta) - time()
+        if stream is True:
+            stream = STREAM_WINDOW
         task = Task(name=task_name, queue=queue, tasks_count=tasks_count,
-                    task_args=task_args, task_kwargs=task_kwargs, callback_queue=self.arbiter_id)
-        return list(self.add_task(task, sync=sync))
+                    task_args=task_args, task_kwargs=task_kwargs, callback_queue=self.arbiter_id,
+                    stream=stream or None, priority=priority)
+        return list(self.add_task(task, sync=sync, delay=countdown))
+
+    def apply_async(self, task_name, queue="default", tasks_count=1, task_args=None, task_kwargs=None, priority=None,
+                    countdown=None, eta=None):
+        """
+        Same as apply, but returns AsyncResult handles instead of task keys
+        """
+        return [self.async_result(task_key) for task_key in
+                self.apply(task_name, queue=queue, tasks_count=tasks_count, task_args=task_args,
+                           task_kwargs=task_kwargs, priority=priority, countdown=countdown, eta=eta)]
+
+    def async_result(self, task_key):
+        handle = self.results.get(task_key)
+        if handle is None:
+            raise NameError("Task not found")
+        return handle
+
+    def stream(self, task_key, timeout=None):
+        """
+        Chunks of generator task applied with stream=True, as they are produced
+        Minion is allowed to run ahead by window size, so slow consumer holds the task back
+        """
+        handle = self.async_result(task_key)
+        if handle.chunks is None:
+            raise ValueError("Task was not applied with stream=True")
+        window = handle.stream_window or STREAM_WINDOW
+        consumed = 0
+        while True:
+            try:
+                chunk = handle.chunks.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No chunks of task {task_key} in {timeout} sec")
+            if chunk is STREAM_END:
+                break
+            yield chunk
+            consumed += 1
+            if consumed >= max(window // 2, 1):
+                message = {"type": "stream_credit", "task_key": task_key, "credit": consumed}
+                if handle.stream_reply_to:
+                    self.send_message(message, queue=handle.stream_reply_to)
+                else:  # minion did not tell its queue, every minion gets the credit
+                    self.send_message(message, exchange=self.config.all)
+                consumed = 0
+        if handle.state.get("state") == "exception":
+            raise ChildProcessError(handle.state.get("result"))
+
+    def map(self, task_name, iterable, chunksize=100, queue="default", ordered=True, window=None, timeout=None,
+            priority=None):
+        """
+        Results of task called with every item of iterable
+        Items are read lazily and sent in chunks of chunksize, every chunk is one task calling it item by item,
+        at most window chunks (2 per worker of the queue by default) are in flight.
+        Results are yielded in order of items or, with ordered=False, as chunks are done;
+        state of a chunk is dropped once its results are yielded
+        """
+        items = iter(iterable)
+
+        def submit():
+            chunk = list(islice(items, chunksize))
+            if not chunk:
+                return None
+            task = Task(task_name, queue=queue, task_args=chunk, callback_queue=self.arbiter_id, priority=priority)
+            task.map = True
+            return self.async_result(list(self.add_task(task))[0])
 
-    def kill(self, task_key, sync=True):
+        if window is None:
+            window = max(2 * self.registry.workers().get(queue, {}).get("total", 0), 2)
+        handles = deque()
+        try:
+            for handle in self._in_flight(submit, handles, window, ordered, timeout):
+                try:
+                    results = handle.get()
+                finally:
+                    self.state.forget(handle.task_key)
+                yield from results
+        finally:
+            # failed chunk or consumer stopped early, chunks left in flight are stopped and not tracked anymore
+            for handle in handles:
+                if not handle.ready():
+                    self.kill(handle.task_key, sync=False)
+                self.state.forget(handle.task_key)
+
+    @staticmethod
+    def _in_flight(submit, handles, window, ordered, timeout):
+        """
+        Done handles of submitted tasks, in submit order or as they are done,
+        window of them kept in flight in handles
+        """
+        done = queue.Queue()
+        exhausted = False
+        while True:
+            while not exhausted and len(handles) < window:
+                handle = submit()
+                if handle is None:
+                    exhausted = True
+                    continue
+                handles.append(handle)
+                if not ordered:
+                    handle.add_done_callback(done.put)
+            if not handles:
+                return
+            if ordered:
+                if not handles[0].wait(timeout):
+                    raise TimeoutError(f"Task {handles[0].task_key} is not done after {timeout} sec")
+                handle = handles.popleft()
+            else:
+                try:
+                    handle = done.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"Tasks are not done after {timeout} sec")
+                handles.remove(handle)
+            yield handle
+
+    def kill(self, task_key, sync=True, timeout=None):
+        """
+        Stop the task, returns ResultSet done once minion confirmed it
+        With sync=True waits up to timeout seconds, unconfirmed keys are in handle.pending
+        """
         message = {
             "type": "stop_task",
             "task_key": task_key,
             "arbiter": self.arbiter_id
         }
+        handle = self.results.register(task_key, self.state.get(task_key))
+        self._cancel_deadline(task_key)
+        if self.followers.pop(task_key, None) is not None:
+            # not dispatched yet, nothing to stop on minions
+            self.results.resolve(task_key, self.state.update_task(task_key, "done", "canceled"))
+            return ResultSet([handle])
         self.send_message(message, exchange=self.config.all)
-        if sync:
-            while True:
-                if task_key in self.state and self.state[task_key]["state"] == "done":
-                    break
-                sleep(self.wait_time)
-
-    def kill_group(self, group_id):
-        tasks = []
-        for task_id in self.state["groups"][group_id]:
+        return self._wait_killed(ResultSet([handle]), sync, timeout)
+
+    def kill_group(self, group_id, sync=True, timeout=None):
+        handles = []
+        # followers first, so killed callback does not release finalizer
+        for task_id in reversed(self.state.group_members(group_id)):
             if task_id in self.state:
-                tasks.append(task_id)
-                self.kill(task_id, sync=False)
-        tasks_done = []
+                handles.append(self.kill(task_id, sync=False).handles[0])
         logging.info("Terminating ...")
-        while not all(task in tasks_done for task in tasks):
-            for task in tasks:
-                if task not in tasks_done and self.state[task]["state"] == 'done':
-                    tasks_done.append(task)
-            sleep(self.wait_time)
+        return self._wait_killed(ResultSet(handles), sync, timeout)
+
+    @staticmethod
+    def _wait_killed(handle, sync, timeout):
+        if sync and not handle.wait(timeout):
+            logging.warning("Tasks were not confirmed as stopped in %s sec: %s", timeout, handle.pending)
+        return handle
 
     def status(self, task_key):
-        if task_key in self.state:
-            return self.state[task_key]
-        elif task_key in self.state["groups"]:
-            group_results = {
-                "state": "done",
-                "initiated": 0,
-                "running": 0,
-                "done": 0,
-                "tasks": []
-            }
-            for task_id in self.state["groups"][task_key]:
-                if task_id in self.state:
-                    if self.state[task_id]["state"] in ["running", "initiated"]:
-                        group_results["state"] = self.state[task_id]["state"]
-                    group_results[self.state[task_id]["state"]] += 1
-                    group_results["tasks"].append(self.state[task_id])
-                else:
-                    logging.info(f"[Group status] {task_id} is missing")
-                    group_results["state"] = "running"
-            return group_results
+        record = self.state.get(task_key)
+        if record is not None:
+            return dict(record)
+        elif self.state.has_group(task_key):
+            return self.state.group_status(task_key)
         else:
             raise NameError("Task or Group not found")
 
+    def group_tasks(self, group_id, offset=0, limit=100):
+        """ Page of group member states, in the order tasks were added """
+        if not self.state.has_group(group_id):
+            raise NameError("Group not found")
+        return [dict(record, task_key=task_key)
+                for task_key, record in self.state.group_tasks(group_id, offset, limit)]
+
+    def forget(self, task_key):
+        """ Drop state and result of finished task or group """
+        if not self.state.forget(task_key):
+            raise NameError("Task or Group not found")
+
+    def stats(self):
+        """ State store counters: entries, evictions and approximate memory """
+        return self.state.stats()
+
     def close(self):
         self.handler.stop()
-        self._get_connection().queue_delete(queue=self.arbiter_id)
+        with self.pool.channel() as channel:
+            channel.queue_delete(queue=self.arbiter_id)
         self.handler.join()
         self.disconnect()
 
-    def workers(self):
+    def _request_state(self):
         message = {
             "type": "state",
             "arbiter": self.arbiter_id
         }
-        if "state" in self.state:
-            del self.state["state"]
+        self.registry.legacy.clear()
         self.send_message(message, exchange=self.config.all)
+
+    def workers(self):
+        """
+        Workers capacity per queue, kept current by minion heartbeats
+        Falls back to broadcast-and-wait when no heartbeats were seen (minions w/o heartbeat support)
+        """
+        workers = self.registry.workers()
+        if workers:
+            return workers
+        self._request_state()
         sleep(self.wait_time)
-        return self.state["state"]
+        return self.registry.workers() or dict(self.registry.legacy)
 
-    def squad(self, tasks, callback=None):
+    def squad(self, tasks, callback=None, priority=None):
         """
         Set of tasks that need to be executed together
         """
@@ -124,74 +279,203 @@ class Arbiter(Base):
         for key in workers_count.keys():
             if not stats.get(key) or stats[key]["available"] < workers_count[key]:
                 raise NameError(f"Not enough of {key} workers")
-        return self.group(tasks, callback)
+        return self.group(tasks, callback, priority)
 
-    def group(self, tasks, callback=None):
+    def group(self, tasks, callback=None, priority=None):
         """
         Set of tasks that need to be executed regardless of order
+        priority applies to tasks (and callback) that have no own priority
         """
         group_id = str(uuid4())
-        self.state["groups"][group_id] = []
+        self.state.add_group(group_id)
         tasks_array = []
         finalizer = None
-        for each in tasks:
+        for each in list(tasks) + ([callback] if callback else []):
+            if each.priority is None:
+                each.priority = priority
             if each.task_type == "finalize":
                 finalizer = each
-                continue
-            task_id = str(uuid4())
-            tasks_array.append(task_id)
-            each.task_key = task_id
-            each.callback_queue = self.arbiter_id
-            if callback:
-                each.callback = True
         for each in tasks:
             if each.task_type == "finalize":
                 continue
-            if finalizer:
-                each.callback = True
+            each.task_key = ""  # every copy gets own key
+            each.callback_queue = self.arbiter_id
             for task in self.add_task(each):
-                self.state["groups"][group_id].append(task)
-        if callback:
-            callback.tasks_array = tasks_array
-            callback.task_key = str(uuid4())
-            callback.callback_queue = self.arbiter_id
-            callback.task_type = "callback"
-            if finalizer:
-                callback.callback = True
-                tasks_array.append(callback.task_key)
-            for task in self.add_task(callback):
-                self.state["groups"][group_id].append(task)
-        if finalizer:
-            finalizer.tasks_array = tasks_array
-            finalizer.task_key = str(uuid4())
-            finalizer.callback_queue = self.arbiter_id
-            for task in self.add_task(finalizer):
-                self.state["groups"][group_id].append(task)
+                tasks_array.append(task)
+                self.state.add_to_group(group_id, task)
+        handles = [self.results.register(task_key) for task_key in tasks_array]
+        for follower, task_type in [(callback, "callback"), (finalizer, "finalize")]:
+            if follower:
+                handles = [self._fan_in(group_id, follower, task_type, handles)]
+        self.state.seal_group(group_id)
         return group_id
 
-    def pipe(self, tasks, persistent_args=None, persistent_kwargs=None):
+    def _fan_in(self, group_id, task, task_type, handles):
+        """
+        Latch dispatching task (group callback or finalizer) as a plain task the moment
+        the last of handles is done, returns handle of the task
+        Finalizer with timeout is dispatched by timer once start_time + timeout has passed
+        """
+        timeout = task.timeout if task_type == "finalize" else -1
+        task.task_key = str(uuid4())
+        task.callback_queue = self.arbiter_id
+        task.tasks_count = 1
+        task.task_type = "task"
+        handle = self.results.register(task.task_key, self.state.add_task(task.task_key, task_type))
+        self.state.add_to_group(group_id, task.task_key)
+        self.followers[task.task_key] = task
+        if timeout != -1:
+            timer = threading.Timer(max(task.start_time + timeout - time(), 0),
+                                    self._dispatch_follower, args=(task, timeout))
+            timer.daemon = True
+            self.deadlines[task.task_key] = timer
+            timer.start()
+        ResultSet(handles).add_done_callback(lambda _: self._dispatch_follower(task))
+        return handle
+
+    def _cancel_deadline(self, task_key):
+        timer = self.deadlines.pop(task_key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _dispatch_follower(self, task, timeout=None):
+        self._cancel_deadline(task.task_key)
+        if self.followers.pop(task.task_key, None) is None:
+            return  # killed or already dispatched
+        if timeout is not None:
+            logging.info("Finalizer timeout: %s sec", timeout)
+        try:
+            list(self.add_task(task))
+        except:  # pylint: disable=W0702
+            logging.exception("Failed to dispatch %s", task.task_key)
+            self.results.resolve(task.task_key, self.state.update_task(task.task_key, "exception", format_exc()))
+
+    def dag(self, tasks, dependencies=None, priority=None):
+        """
+        Tasks (name -> Task) started as soon as tasks they depend on (name -> upstream names) are done
+        Results of upstream tasks are passed in `upstream` kwarg as name -> result,
+        tasks depending on failed one are not started and fail too
+        """
+        dependencies = dependencies or {}
+        order = self._topological_order(tasks, dependencies)
+        dag_id = str(uuid4())
+        self.state.add_group(dag_id)
+        handles = {}
+        for name in order:
+            task = tasks[name]
+            if task.priority is None:
+                task.priority = priority
+            task.task_key = str(uuid4())
+            task.callback_queue = self.arbiter_id
+            task.tasks_count = 1
+            task.task_type = "task"
+            handles[name] = self.results.register(task.task_key, self.state.add_task(task.task_key))
+            self.state.add_to_group(dag_id, task.task_key)
+            self.followers[task.task_key] = task
+            upstream = {each: handles[each] for each in dependencies.get(name, [])}
+            ResultSet(upstream.values()).add_done_callback(
+                lambda _, task=task, upstream=upstream: self._dispatch_node(task, upstream)
+            )
+        self.state.seal_group(dag_id)
+        return dag_id
+
+    @staticmethod
+    def _topological_order(tasks, dependencies):
+        """ Task names, each one after all of its upstream tasks """
+        for name, upstream in dependencies.items():
+            for each in [name] + list(upstream):
+                if each not in tasks:
+                    raise NameError(f"Task {each} is not a part of the dag")
+        waiting = {name: set(dependencies.get(name, [])) for name in tasks}
+        order = []
+        while waiting:
+            ready = [name for name, upstream in waiting.items() if not upstream]
+            if not ready:
+                raise ValueError(f"Dependency cycle between tasks {sorted(waiting)}")
+            for name in ready:
+                waiting.pop(name)
+            for upstream in waiting.values():
+                upstream.difference_update(ready)
+            order.extend(ready)
+        return order
+
+    def _dispatch_node(self, task, upstream):
+        failed = [name for name, handle in upstream.items() if self._failed(handle)]
+        if failed:
+            if self.followers.pop(task.task_key, None) is not None:
+                self._fail_tasks([self.results.get(task.task_key)], f"Upstream tasks failed: {', '.join(failed)}")
+            return
+        if upstream:
+            task.task_kwargs["upstream"] = {name: handle.get() for name, handle in upstream.items()}
+        self._dispatch_follower(task)
+
+    def pipe(self, tasks, persistent_args=None, persistent_kwargs=None, chained=False, timeout=None):
         """
         Set of tasks that need to be executed sequentially
         NOTE: Persistent args always before the task args
               Task itself need to have **kwargs if you want to ignore upstream results
+        With chained=True remaining stages travel with the task message and minion sends result
+        straight to the next stage, only result of the last stage is reported to arbiter;
+        stage not done in timeout (sec) fails with the rest of the pipe and TimeoutError is raised
         """
         pipe_id = str(uuid4())
-        self.state["groups"][pipe_id] = []
+        self.state.add_group(pipe_id)
         if not persistent_args:
             persistent_args = []
         if not persistent_kwargs:
             persistent_kwargs = {}
         res = {}
         yield {"pipe_id": pipe_id}
+        try:
+            if chained:
+                yield from self._chain(pipe_id, list(tasks), persistent_args, persistent_kwargs, timeout)
+                return
+            for task in tasks:
+                task.callback_queue = self.arbiter_id
+                task.task_args = persistent_args + task.task_args
+                for key, value in persistent_kwargs.items():
+                    if key not in task.task_kwargs:
+                        task.task_kwargs[key] = value
+                if res:
+                    task.task_kwargs['upstream'] = res.get("result")
+                res = list(self.add_task(task, sync=True))
+                self.state.add_to_group(pipe_id, res[0])
+                res = res[1]
+                yield res
+        finally:
+            self.state.seal_group(pipe_id)
+
+    def _chain(self, pipe_id, tasks, persistent_args, persistent_kwargs, timeout):
+        handles = []
         for task in tasks:
+            task.task_key = str(uuid4())
             task.callback_queue = self.arbiter_id
+            task.tasks_count = 1
             task.task_args = persistent_args + task.task_args
-            for key, value in persistent_kwargs:
+            for key, value in persistent_kwargs.items():
                 if key not in task.task_kwargs:
                     task.task_kwargs[key] = value
-            if res:
-                task.task_kwargs['upstream'] = res.get("result")
-            res = list(self.add_task(task, sync=True))
-            self.state["groups"][pipe_id].append(res[0])
-            res = res[1]
-            yield res
+            handles.append(self.results.register(task.task_key, self.state.add_task(task.task_key, task.task_type)))
+            self.state.add_to_group(pipe_id, task.task_key)
+        if not tasks:
+            return
+        tasks[0].chain = [task.to_json() for task in tasks[1:]]
+        list(self.add_task(tasks[0]))
+        for index, handle in enumerate(handles):
+            if not handle.wait(timeout):
+                # minion w/o chain support or lost forward, nothing will report the rest
+                self._fail_tasks(handles[index:], f"Stage {handle.task_key} is not done after {timeout} sec")
+                raise TimeoutError(f"Task {handle.task_key} is not done after {timeout} sec")
+            yield self.status(handle.task_key)
+            if self._failed(handle):
+                self._fail_tasks(handles[index + 1:], f"Upstream stage {handle.task_key} did not finish")
+                return
+
+    @staticmethod
+    def _failed(handle):
+        """ Task ended with exception or was killed """
+        return not handle.successful() or handle.state.get("result") == "canceled"
+
+    def _fail_tasks(self, handles, reason):
+        for handle in handles:
+            self.results.resolve(handle.task_key, self.state.update_task(handle.task_key, "exception", reason))
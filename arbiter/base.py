@@ -13,133 +13,219 @@
 #   limitations under the License.
 
 
+import queue
 import logging
 import pika
 import ssl
 
+from time import time
 from uuid import uuid4
-from json import dumps
 
+from arbiter.blobs import BLOB_KEY, is_blob, offload
+from arbiter.codec import properties_for
 from arbiter.config import Config
 from arbiter.event.arbiter import ArbiterEventHandler
-
-connection = None
-channel = None
+from arbiter.pool import ChannelPool
+from arbiter.publisher import ConfirmPublisher
+from arbiter.queues import DELAY_QUEUE_EXPIRES, declare_delay_queue, delay_queue, migrate_queue
+from arbiter.result import ResultRegistry, ResultSet
+from arbiter.state import MemoryStateStore
 
 
 class Base:
-    def __init__(self, host, port, user, password, vhost="carrier", queue=None, all_queue="arbiterAll", wait_time=2.0, use_ssl=False, ssl_verify=False):
-        self.config = Config(host, port, user, password, vhost, queue, all_queue, use_ssl, ssl_verify)
-        self.state = dict()
+    def __init__(self, host, port, user, password, vhost="carrier", queue=None, all_queue="arbiterAll", wait_time=2.0, use_ssl=False, ssl_verify=False, pool_size=4, confirm=False, state_store=None, codec=None,
+                 blob_store=None, blob_threshold=1024 * 1024, max_priority=None):
+        self.config = Config(host, port, user, password, vhost, queue, all_queue, use_ssl, ssl_verify, codec,
+                             blob_store, blob_threshold, max_priority)
+        self.state = state_store if state_store is not None else MemoryStateStore()
+        self.results = ResultRegistry()
+        self.state.on_evict.append(self.results.forget)
         self.wait_time = wait_time
+        self.delay_queues = dict()  # delay queue -> time it was declared
+        self.pool = ChannelPool(self._get_connection, self._prepare_channel, max_size=pool_size)
+        self.publisher = None
+        if confirm:
+            with self.pool.channel():
+                pass  # exchanges and queues are declared on blocking pool connection
+            self.publisher = ConfirmPublisher(self._get_parameters)
+            self.publisher.start()
 
-    def _get_connection(self):
-        global connection
-        global channel
-        if not connection:
-            ssl_options = None
-            #
-            if self.config.use_ssl:
-                ssl_context = ssl.create_default_context()
-                if self.config.ssl_verify:
-                    ssl_context.verify_mode = ssl.CERT_REQUIRED
-                    ssl_context.check_hostname = True
-                    ssl_context.load_default_certs()
-                else:
-                    ssl_context.check_hostname = False
-                    ssl_context.verify_mode = ssl.CERT_NONE
-                ssl_server_hostname = self.config.host
-                #
-                ssl_options = pika.SSLOptions(ssl_context, ssl_server_hostname)
+    def _get_parameters(self):
+        ssl_options = None
+        #
+        if self.config.use_ssl:
+            ssl_context = ssl.create_default_context()
+            if self.config.ssl_verify:
+                ssl_context.verify_mode = ssl.CERT_REQUIRED
+                ssl_context.check_hostname = True
+                ssl_context.load_default_certs()
+            else:
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+            ssl_server_hostname = self.config.host
             #
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host=self.config.host,
-                    port=self.config.port,
-                    virtual_host=self.config.vhost,
-                    credentials=pika.PlainCredentials(
-                        self.config.user,
-                        self.config.password
-                    ),
-                    ssl_options=ssl_options,
-                )
-            )
-        if not channel:
-            channel = connection.channel()
-            if self.config.queue:
-                channel.queue_declare(
-                    queue=self.config.queue, durable=True
-                )
-            channel.exchange_declare(
-                exchange=self.config.all,
-                exchange_type="fanout", durable=True
+            ssl_options = pika.SSLOptions(ssl_context, ssl_server_hostname)
+        #
+        return pika.ConnectionParameters(
+            host=self.config.host,
+            port=self.config.port,
+            virtual_host=self.config.vhost,
+            credentials=pika.PlainCredentials(
+                self.config.user,
+                self.config.password
+            ),
+            ssl_options=ssl_options,
+        )
+
+    def _get_connection(self):
+        return pika.BlockingConnection(self._get_parameters())
+
+    def _prepare_channel(self, channel):
+        if self.config.queue:
+            channel.queue_declare(
+                queue=self.config.queue, durable=True, arguments=self.config.queue_arguments
             )
+        channel.exchange_declare(
+            exchange=self.config.all,
+            exchange_type="fanout", durable=True
+        )
+
+    def disconnect(self):
+        self.pool.close()
+        if self.publisher:
+            self.publisher.stop()
+            self.publisher.join()
+            self.publisher = None
+
+    def migrate_queue(self, queue=None):
+        """
+        Redeclare existing durable task queue with current arguments (e.g. max_priority), keeping its messages
+        Stop minions consuming the queue and arbiters publishing to it before migration
+        """
+        connection = self._get_connection()
         try:
-            connection.process_data_events()
-        except:
-            connection = None
-            channel = None
-            return self._get_connection()
-        return channel
-
-    @staticmethod
-    def disconnect():
-        global connection
-        global channel
-        if connection:
+            return migrate_queue(connection.channel(), queue or self.config.queue, self.config.queue_arguments)
+        finally:
             connection.close()
-        connection = None
-        channel = None
 
-    def send_message(self, msg, reply_to="", queue="", exchange=""):
-        self._get_connection().basic_publish(
+    def _delayed(self, queue, delay):
+        """ Routing key for message delivered to queue after delay sec, delay queues are redeclared before they expire """
+        if not delay or delay <= 0:
+            return queue
+        name, _ = delay_queue(queue, delay)
+        now = time()
+        if now - self.delay_queues.get(name, 0) > DELAY_QUEUE_EXPIRES / 2000:
+            with self.pool.channel() as channel:
+                declare_delay_queue(channel, queue, delay)
+            # entries older than that are redeclared anyway, keep cache to recently used queues
+            for each, declared in list(self.delay_queues.items()):
+                if now - declared > DELAY_QUEUE_EXPIRES / 2000:
+                    self.delay_queues.pop(each, None)
+            self.delay_queues[name] = now
+        return name
+
+    def send_message(self, msg, reply_to="", queue="", exchange="", priority=None, delay=None):
+        """
+        Publish message, in confirm mode returns Future resolved on broker ack
+        With delay (sec) message is delivered to queue by broker after that
+        """
+        if not exchange:
+            queue = self._delayed(queue, delay)
+        body = self.config.codec.encode(msg)
+        properties = pika.BasicProperties(**properties_for(
+            self.config.codec,
+            reply_to=reply_to,
+            delivery_mode=2,
+            priority=priority
+        ))
+        if self.publisher:
+            return self.publisher.publish(exchange, queue, body, properties)
+        self.pool.publish(
             exchange=exchange, routing_key=queue,
-            body=dumps(msg).encode("utf-8"),
-            properties=pika.BasicProperties(
-                reply_to=reply_to,
-                delivery_mode=2
-            )
+            body=body, properties=properties
         )
+        return None
 
-    def wait_for_tasks(self, tasks):
-        tasks_done = []
-        while not all(task in tasks_done for task in tasks):
-            for task in tasks:
-                if task not in tasks_done and self.state[task]["state"] == 'done':
-                    tasks_done.append(task)
-                    yield self.state[task]
+    def _encode_copies(self, message, task_keys):
+        """
+        Encode message once, then only patch task_key for every copy
+        Keys of other length than placeholder (not generated ones) are encoded in full
+        """
+        codec = self.config.codec
+        placeholder = str(uuid4())
+        head, tail = codec.encode(dict(message, task_key=placeholder)).split(placeholder.encode("utf-8"), 1)
+        for task_key in task_keys:
+            if len(task_key) == len(placeholder) and task_key.isascii() and task_key.replace("-", "").isalnum():
+                yield head + task_key.encode("utf-8") + tail
+            else:
+                yield codec.encode(dict(message, task_key=task_key))
 
-    def add_task(self, task, sync=False):
+    def _cleanup_blobs(self, message, tasks):
+        """ Offloaded args are shared by all copies of the task, delete them once every copy is done """
+        refs = [message[key][BLOB_KEY] for key in ["args", "kwargs"] if is_blob(message[key])]
+        handles = [self.results.get(task_key) for task_key in tasks]
+        if not refs or None in handles:
+            return
+        store = self.config.blob_store
+        ResultSet(handles).add_done_callback(lambda _: [store.delete(ref) for ref in refs])
+
+    def wait_for_tasks(self, tasks, timeout=None):
+        for handle in self.results.as_completed(tasks, timeout=timeout):
+            yield dict(handle.state)
+
+    def add_task(self, task, sync=False, delay=None):
         generated_queue = False
         if not task.callback_queue and sync:
             generated_queue = True
             queue_id = str(uuid4())
-            self._get_connection().queue_declare(
-                queue=queue_id, durable=True
-            )
+            with self.pool.channel() as channel:
+                channel.queue_declare(
+                    queue=queue_id, durable=True
+                )
             task.callback_queue = queue_id
         tasks = []
+        message = task.to_json()
+        logging.debug(f"Task body {message}")
+        for key in ["args", "kwargs"]:
+            message[key] = offload(self.config.blob_store, message[key], self.config.codec, self.config.blob_threshold)
+        deliveries = {}
         for _ in range(task.tasks_count):
             task_key = str(uuid4()) if task.task_key == "" else task.task_key
             tasks.append(task_key)
             if task.callback_queue and task_key not in self.state:
-                self.state[task_key] = {
-                    "task_type": task.task_type,
-                    "state": "initiated"
-                }
-            logging.debug(f"Task body {task.to_json()}")
-            message = task.to_json()
-            message["task_key"] = task_key
-            self.send_message(message, reply_to=task.callback_queue, queue=task.queue)
+                handle = self.results.register(task_key, self.state.add_task(task_key, task.task_type))
+                if task.stream:
+                    handle.chunks = queue.Queue()
+                    handle.stream_window = task.stream
+            if task.tasks_count == 1:
+                message["task_key"] = task_key
+                deliveries[task_key] = self.send_message(message, reply_to=task.callback_queue, queue=task.queue,
+                                                         priority=task.priority, delay=delay)
+        if task.tasks_count > 1:
+            properties = pika.BasicProperties(**properties_for(
+                self.config.codec, reply_to=task.callback_queue, delivery_mode=2, priority=task.priority
+            ))
+            routing_key = self._delayed(task.queue, delay)
+            if self.publisher:
+                for task_key, body in zip(tasks, self._encode_copies(message, tasks)):
+                    deliveries[task_key] = self.publisher.publish("", routing_key, body, properties)
+            else:
+                self.pool.publish_batch("", routing_key, self._encode_copies(message, tasks), properties)
+        for task_key, delivery in deliveries.items():
+            handle = self.results.get(task_key)
+            if delivery is not None and handle is not None:
+                handle.delivery = delivery
+        self._cleanup_blobs(message, tasks)
+        for task_key in tasks:
             yield task_key
         if generated_queue:
-            handler = ArbiterEventHandler(self.config, {}, self.state, task.callback_queue)
+            handler = ArbiterEventHandler(self.config, {}, self.state, task.callback_queue, self.results)
             handler.start()
         if sync:
             for message in self.wait_for_tasks(tasks):
                 yield message
         if generated_queue:
             handler.stop()
-            self._get_connection().queue_delete(queue=task.callback_queue)
+            with self.pool.channel() as channel:
+                channel.queue_delete(queue=task.callback_queue)
             handler.join()
-            self.disconnect()
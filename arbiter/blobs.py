@@ -0,0 +1,191 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Out-of-band store for large task args and results (claim-check)
+
+    Payload above threshold is put into blob store and only a reference travels
+    in the message: {"__arbiter_blob__": ref, "codec": codec name, "size": bytes}.
+    Arbiter and minions need to be configured with the same store (shared directory,
+    or the same host for shared memory)
+"""
+
+import os
+import time
+import inspect
+import struct
+import logging
+import threading
+from uuid import uuid4
+from multiprocessing import shared_memory, resource_tracker
+
+from arbiter.codec import get_codec
+
+BLOB_KEY = "__arbiter_blob__"
+
+
+class BlobStore:
+    def put(self, data):
+        """ Save bytes, returns reference """
+        raise NotImplementedError
+
+    def get(self, ref):
+        raise NotImplementedError
+
+    def delete(self, ref):
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """ Blobs as files in directory, shared between hosts with a network filesystem """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, data):
+        ref = str(uuid4())
+        tmp_path = os.path.join(self.path, f".{ref}.tmp")
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, os.path.join(self.path, ref))
+        return ref
+
+    def get(self, ref):
+        with open(os.path.join(self.path, ref), "rb") as file:
+            return file.read()
+
+    def delete(self, ref):
+        try:
+            os.remove(os.path.join(self.path, ref))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self, max_age):
+        """ Remove blobs older than max_age seconds, e.g. of tasks nobody tracked """
+        expired = time.time() - max_age
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+
+
+class SharedMemoryBlobStore(BlobStore):
+    """ Blobs in POSIX shared memory, arbiter and minions on the same host only """
+    header = struct.Struct("!Q")
+
+    def put(self, data):
+        ref = f"arb{uuid4().hex[:24]}"
+        segment = shared_memory.SharedMemory(name=ref, create=True, size=self.header.size + len(data))
+        try:
+            self.header.pack_into(segment.buf, 0, len(data))
+            segment.buf[self.header.size:self.header.size + len(data)] = data
+        finally:
+            segment.close()
+        self._untrack(segment)  # blob outlives the process which created it
+        return ref
+
+    def get(self, ref):
+        segment = self._attach(ref)
+        try:
+            size = self.header.unpack_from(segment.buf, 0)[0]
+            return bytes(segment.buf[self.header.size:self.header.size + size])
+        finally:
+            segment.close()
+
+    def delete(self, ref):
+        try:
+            segment = self._attach(ref)
+        except FileNotFoundError:
+            return
+        segment.close()
+        segment.unlink()
+
+    def _attach(self, ref):
+        segment = shared_memory.SharedMemory(name=ref)
+        self._untrack(segment)
+        return segment
+
+    @staticmethod
+    def _untrack(segment):
+        try:
+            resource_tracker.unregister(segment._name, "shared_memory")  # pylint: disable=W0212
+        except:  # pylint: disable=W0702
+            pass
+
+
+class BlobRef:
+    """ Lazily loaded payload, blob is deleted once loaded """
+    __slots__ = ("store", "ref", "codec", "size", "lock", "value", "loaded")
+
+    def __init__(self, store, marker):
+        self.store = store
+        self.ref = marker[BLOB_KEY]
+        self.codec = marker["codec"]
+        self.size = marker.get("size")
+        self.lock = threading.Lock()
+        self.value = None
+        self.loaded = False
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                self.value = get_codec(self.codec).decode(self.store.get(self.ref))
+                self.loaded = True
+                self.discard()
+            return self.value
+
+    def discard(self):
+        try:
+            self.store.delete(self.ref)
+        except:  # pylint: disable=W0702
+            logging.exception("Failed to delete blob %s", self.ref)
+
+    def __repr__(self):
+        return f"<BlobRef {self.ref} {self.size} bytes>"
+
+
+def is_blob(value):
+    return isinstance(value, dict) and BLOB_KEY in value
+
+
+def offload(store, value, codec, threshold):
+    """ Put value into store when encoded value is larger than threshold """
+    if store is None or value is None:
+        return value
+    data = codec.encode(value)
+    if len(data) <= threshold:
+        return value
+    return {BLOB_KEY: store.put(data), "codec": codec.name, "size": len(data)}
+
+
+def load(store, value, delete=False):
+    if not is_blob(value):
+        return value
+    data = store.get(value[BLOB_KEY])
+    if delete:
+        store.delete(value[BLOB_KEY])
+    return get_codec(value["codec"]).decode(data)
+
+
+def call_with_blobs(func, args, kwargs, store, codec, threshold):
+    """ Runs in worker process: args are loaded and result is offloaded there, not in the minion """
+    kwargs = load(store, kwargs)
+    if is_blob(kwargs.get("upstream")):
+        # result of previous chained pipe stage, minion deletes it once this stage is acked
+        kwargs = dict(kwargs, upstream=load(store, kwargs["upstream"]))
+    result = func(*load(store, args), **kwargs)
+    if inspect.isgenerator(result):
+        return result  # streamed by executor, chunk by chunk
+    return offload(store, result, get_codec(codec), threshold)
@@ -0,0 +1,118 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Wire codecs for task and control messages
+
+    Codec is announced in AMQP content_type, so receivers pick decoder per message.
+    Messages without content_type (older arbiter and minion versions) are JSON
+"""
+
+import json
+
+try:
+    import orjson  # pylint: disable=E0401
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack  # pylint: disable=E0401
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+    content_encoding = "utf-8"
+
+    @staticmethod
+    def encode(message):
+        return json.dumps(message).encode("utf-8")
+
+    @staticmethod
+    def decode(body):
+        return json.loads(body)
+
+
+class OrjsonCodec(JsonCodec):
+    """ Same wire format as JsonCodec, encoded by orjson """
+    name = "orjson"
+
+    @staticmethod
+    def encode(message):
+        return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def decode(body):
+        return orjson.loads(body)
+
+
+class MsgpackCodec:
+    """ Binary codec, bytes are sent as is """
+    name = "msgpack"
+    content_type = "application/msgpack"
+    content_encoding = "binary"
+
+    @staticmethod
+    def encode(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(body):
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "msgpack": MsgpackCodec,
+}
+REQUIREMENTS = {
+    "orjson": lambda: orjson,
+    "msgpack": lambda: msgpack,
+}
+
+
+def get_codec(codec=None):
+    """ Codec by name (json, orjson, msgpack) or codec object itself """
+    if codec is None:
+        return JsonCodec
+    if not isinstance(codec, str):
+        return codec
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec: {codec}")
+    if codec in REQUIREMENTS and REQUIREMENTS[codec]() is None:
+        raise ImportError(f"Codec '{codec}' requires '{codec}' package to be installed")
+    return CODECS[codec]
+
+
+def codec_for(properties, local=None):
+    """ Codec of received message, local codec is preferred when it has the same content type """
+    content_type = getattr(properties, "content_type", None) or JsonCodec.content_type
+    if local is not None and local.content_type == content_type:
+        return local
+    for codec in CODECS.values():
+        if codec.content_type == content_type:
+            return get_codec(codec.name)
+    raise ValueError(f"Unsupported content type: {content_type}")
+
+
+def decode(body, properties=None, local=None):
+    return codec_for(properties, local).decode(body)
+
+
+def properties_for(codec, **kwargs):
+    """ BasicProperties kwargs announcing codec """
+    return dict(kwargs, content_type=codec.content_type, content_encoding=codec.content_encoding)
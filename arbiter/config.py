@@ -15,6 +15,8 @@
 
 import logging
 
+from arbiter.codec import get_codec
+
 logging.basicConfig(
     level=logging.INFO,
     datefmt="%Y.%m.%d %H:%M:%S %Z",
@@ -23,7 +25,8 @@ logging.basicConfig(
 
 
 class Config(object):
-    def __init__(self, host, port, user, password, vhost, queue, all_queue, use_ssl=False, ssl_verify=False):
+    def __init__(self, host, port, user, password, vhost, queue, all_queue, use_ssl=False, ssl_verify=False, codec=None,
+                 blob_store=None, blob_threshold=1024 * 1024, max_priority=None):
         self.host = host
         self.port = port
         self.user = user
@@ -31,5 +34,17 @@ class Config(object):
         self.vhost = vhost
         self.queue = queue
         self.all = all_queue
+        self.heartbeat = f"{all_queue}Heartbeat" if all_queue else None
         self.use_ssl = use_ssl
         self.ssl_verify = ssl_verify
+        self.codec = get_codec(codec)
+        self.blob_store = blob_store
+        self.blob_threshold = blob_threshold
+        self.max_priority = max_priority
+
+    @property
+    def queue_arguments(self):
+        """ Arguments of task queue declaration, priority queue when max_priority is set """
+        if self.max_priority:
+            return {"x-max-priority": self.max_priority}
+        return None
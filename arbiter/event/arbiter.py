@@ -13,16 +13,50 @@
 #   limitations under the License.
 
 
-import json
 import logging
 
 from arbiter.event.base import BaseEventHandler
+from arbiter.blobs import BlobRef, is_blob
+from arbiter.state import MISSING
+
+
+def apply_event(event, state, results=None, workers=None, blob_store=None):
+    """ Update arbiter state, result handles and workers registry from minion event """
+    event_type = event.get("type")
+    task_key = event.get("task_key")
+    if event.get("capacity") and workers is not None:
+        workers.update(event.get("capacity"))
+    if event_type in ["task_state_change", "task_chunk", "result"] and task_key not in state:
+        # forgotten or evicted task, late event must not bring it back
+        if is_blob(event.get("result")) and blob_store is not None:
+            BlobRef(blob_store, event.get("result")).discard()
+        return
+    if event_type in ["task_state_change"]:
+        result = event.get("result", MISSING)
+        if is_blob(result) and blob_store is not None:
+            result = BlobRef(blob_store, result)
+        record = state.update_task(task_key, event.get("task_state"), result)
+        if record.finished and results is not None:
+            results.resolve(task_key, record)
+    if event_type == "task_chunk" and results is not None:
+        results.push_chunk(task_key, event.get("chunk"), event.get("reply_to"))
+    if event_type == "state" and workers is not None:
+        if event.get("minion_id"):
+            workers.update(event)
+        else:
+            workers.update_legacy(event)
+    if event_type == "result":
+        record = state.update_task(task_key, "done", event.get("message"))
+        if results is not None:
+            results.resolve(task_key, record)
 
 
 class ArbiterEventHandler(BaseEventHandler):
-    def __init__(self, settings, subscriptions, state, arbiter_id):
+    def __init__(self, settings, subscriptions, state, arbiter_id, results=None, workers=None):
         super().__init__(settings, subscriptions, state)
         self.arbiter_id = arbiter_id
+        self.results = results
+        self.workers = workers
 
     def _connect_to_specific_queue(self, channel):
         channel.queue_declare(
@@ -33,36 +67,37 @@ class ArbiterEventHandler(BaseEventHandler):
             queue=self.arbiter_id,
             on_message_callback=self.queue_event_callback
         )
+        if self.workers is not None:
+            channel.exchange_declare(
+                exchange=self.settings.heartbeat,
+                exchange_type="fanout", durable=True
+            )
+            heartbeat_queue = channel.queue_declare(queue="", exclusive=True)
+            channel.queue_bind(
+                exchange=self.settings.heartbeat,
+                queue=heartbeat_queue.method.queue
+            )
+            channel.basic_consume(
+                queue=heartbeat_queue.method.queue,
+                on_message_callback=self.heartbeat_callback,
+                auto_ack=True
+            )
         logging.info("[%s] Waiting for task events", self.ident)
         return channel
 
+    def heartbeat_callback(self, channel, method, properties, body):
+        _ = properties, channel, method
+        try:
+            self.workers.update(self.codec_for(properties).decode(body))
+        except:  # pylint: disable=W0702
+            logging.exception("[%s] [Heartbeat] Got exception", self.ident)
+
     def queue_event_callback(self, channel, method, properties, body):  # pylint: disable=R0912,R0915
         _ = properties, self, channel, method
-        event = json.loads(body)
         try:
-            event_type = event.get("type")
-            logging.info("[%s] [ArbiterEvent] Type: %s", self.ident, event_type)
-            if event.get("task_key") and event.get("task_key") not in self.state:
-                self.state[event.get("task_key")] = {}
-            if event_type in ["task_state_change"]:
-                self.state[event.get("task_key")]["state"] = event.get("task_state")
-                if event.get("result"):
-                    self.state[event.get("task_key")]["result"] = event.get("result")
-            if event_type == "state":
-                queue = event["queue"]
-                del event["type"]
-                del event["queue"]
-                if "state" not in self.state:
-                    self.state["state"] = {}
-                if queue not in self.state["state"]:
-                    self.state["state"][queue] = {}
-                for key, value in event.items():
-                    if key not in self.state["state"][queue]:
-                        self.state["state"][queue][key] = 0
-                    self.state["state"][queue][key] += value
-            if event_type == "result":
-                self.state[event.get("task_key")]["state"] = "done"
-                self.state[event.get("task_key")]["result"] = event.get("message")
+            event = self.codec_for(properties).decode(body)
+            logging.info("[%s] [ArbiterEvent] Type: %s", self.ident, event.get("type"))
+            apply_event(event, self.state, self.results, self.workers, self.settings.blob_store)
         except:
             logging.exception("[%s] [TaskEvent] Got exception", self.ident)
         channel.basic_ack(delivery_tag=method.delivery_tag)
@@ -14,12 +14,14 @@
 
 
 import time
-import json
 import threading
 import pika
 import ssl
 import logging
 
+from arbiter.codec import codec_for, properties_for
+from arbiter.queues import declare_delay_queue
+
 
 class BaseEventHandler(threading.Thread):
     """ Basic representation of events handler"""
@@ -31,6 +33,7 @@ class BaseEventHandler(threading.Thread):
         self.subscriptions = subscriptions
         self._stop_event = threading.Event()
         self.started = False
+        self.error = None  # fatal error the handler stopped on
         self.wait_time = wait_time
 
     def _get_connection(self):
@@ -69,7 +72,7 @@ class BaseEventHandler(threading.Thread):
         channel = connection.channel()
         if self.settings.queue:
             channel.queue_declare(
-                queue=self.settings.queue, durable=True
+                queue=self.settings.queue, durable=True, arguments=self.settings.queue_arguments
             )
         channel.exchange_declare(
             exchange=self.settings.all,
@@ -105,8 +108,21 @@ class BaseEventHandler(threading.Thread):
                 logging.info("Connection Closed by Broker")
                 time.sleep(5.0)
                 continue
+            except pika.exceptions.ChannelClosedByBroker as error:
+                if error.reply_code != 406:  # PRECONDITION_FAILED can not be fixed by reconnecting
+                    logging.info("Channel Closed by Broker")
+                    time.sleep(5.0)
+                    continue
+                logging.error("[%s] Queue can not be declared with current arguments: %s. Existing durable queue "
+                              "keeps its arguments, stop its minions and run migrate_queue() once",
+                              self.ident, error.reply_text)
+                self.error = error
+                self.stop()
+                return
             except pika.exceptions.AMQPChannelError:
                 logging.info("AMQPChannelError")
+                time.sleep(5.0)
+                continue
             except pika.exceptions.StreamLostError:
                 logging.info("Recovering from error")
                 time.sleep(5.0)
@@ -123,17 +139,24 @@ class BaseEventHandler(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
-    @staticmethod
-    def respond(channel, message, queue, delay=0):
+    def codec_for(self, properties):
+        """ Codec of received message, replies are encoded with it so older peers understand them """
+        return codec_for(properties, self.settings.codec)
+
+    def respond(self, channel, message, queue, delay=0, exchange="", codec=None, priority=None):
+        """ Publish message, with delay (sec) it is held by broker in delay queue, consumer is not blocked """
         logging.debug(message)
-        if delay and isinstance(delay, int):
-            time.sleep(delay)
+        codec = codec if codec is not None else self.settings.codec
+        if delay and not exchange:
+            queue = declare_delay_queue(channel, queue, delay)
         channel.basic_publish(
-            exchange="", routing_key=queue,
-            body=json.dumps(message).encode("utf-8"),
-            properties=pika.BasicProperties(
+            exchange=exchange, routing_key=queue,
+            body=codec.encode(message),
+            properties=pika.BasicProperties(**properties_for(
+                codec,
                 delivery_mode=2,
-            )
+                priority=priority,
+            ))
         )
 
     def queue_event_callback(self, channel, method, properties, body):  # pylint: disable=R0912,R0915
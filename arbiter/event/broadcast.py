@@ -13,16 +13,27 @@
 #   limitations under the License.
 
 
-import json
 import logging
 
 from arbiter.event.base import BaseEventHandler
+from arbiter.registry import capacity_message
 
 
 class GlobalEventHandler(BaseEventHandler):
+    def __init__(self, settings, subscriptions, state, wait_time=2.0):
+        super().__init__(settings, subscriptions, state, wait_time=wait_time)
+        self.channel = None
 
     def _connect_to_specific_queue(self, channel):
+        channel.exchange_declare(
+            exchange=self.settings.heartbeat,
+            exchange_type="fanout", durable=True
+        )
+        self.channel = channel
+        channel.connection.call_later(0, self._heartbeat)
         exchange_queue = channel.queue_declare(queue="", exclusive=True)
+        # messages for this minion only (stream credit) are sent straight to it
+        self.state["global_queue"] = exchange_queue.method.queue
         channel.queue_bind(
             exchange=self.settings.all,
             queue=exchange_queue.method.queue
@@ -36,11 +47,22 @@ class GlobalEventHandler(BaseEventHandler):
         logging.info("Waiting for global events")
         return channel
 
+    def _heartbeat(self):
+        """ Publish capacity to arbiters and schedule next heartbeat on consumer connection """
+        if self.stopped() or not self.channel or not self.channel.is_open:
+            return
+        try:
+            self.respond(self.channel, capacity_message(self.state), "", exchange=self.settings.heartbeat)
+        except:  # pylint: disable=W0702
+            logging.exception("[GlobalEvent] Heartbeat failed")
+        self.channel.connection.call_later(self.state["heartbeat_interval"], self._heartbeat)
+
     def queue_event_callback(self, channel, method, properties, body):
         """ Process event """
         _ = properties, self, channel, method
         try:
-            event = json.loads(body)
+            codec = self.codec_for(properties)
+            event = codec.decode(body)
             #
             event_type = event.get("type", None)
             logging.info("[GlobalEvent] Type: %s", event_type)
@@ -49,25 +71,35 @@ class GlobalEventHandler(BaseEventHandler):
                 task_key = event.get("task_key")
                 if task_key in self.state and not self.state[task_key]["process"].ready():
                     logging.info("[GlobalEvent] Terminating task %s", task_key)
-                    self.state[task_key]["status"] = "canceled"
+                    record = self.state[task_key]
+                    status = record["status"]
+                    # set before cancel, so it never overwrites "done" set by task done callback
+                    record["status"] = "canceled"
+                    if not record["process"].cancel():  # other tasks of the minion keep running
+                        logging.warning("[GlobalEvent] Task %s can not be stopped by its executor", task_key)
+                        if record["status"] == "canceled":  # not "done" meanwhile
+                            record["status"] = status
+            elif event_type == "stream_credit":
+                task_key = event.get("task_key")
+                if task_key in self.state and not self.state[task_key]["process"].ready():
+                    self.state[task_key]["process"].grant(event.get("credit", 1))
             elif event_type == "subscription_notification":
                 subscription = event.get("subscription")
                 if subscription in self.subscriptions:
                     logging.info("[GlobalEvent] Got data for subscription %s", subscription)
                     self.subscriptions[subscription] = event.get("data")
             elif event_type == "state":
-                message = {"queue": self.state["queue"], "active": self.state["active_workers"],
-                           "total": self.state["total_workers"],
-                           "available": self.state["total_workers"] - self.state["active_workers"],
-                           "type": "state"}
-                logging.debug(json.dumps(message, indent=2))
-                self.respond(channel, message, event["arbiter"])
+                message = capacity_message(self.state, "state")
+                logging.debug(message)
+                self.respond(channel, message, event["arbiter"], codec=codec)
             elif event_type == "task_state":
-                response = {"type": "task_state"}
+                response = {"type": "task_state", "minion_id": self.state["minion_id"]}
+                if event.get("request_id"):
+                    response["request_id"] = event["request_id"]
                 for each in event.get("tasks", []):
                     if each in self.state:
                         response[each] = True if self.state[each]["status"] != "done" else False
-                self.respond(channel, response, event["arbiter"])
+                self.respond(channel, response, event["arbiter"], codec=codec)
             elif event_type == "clear_state":
                 for task in event.get("tasks", []):
                     if task in self.state:
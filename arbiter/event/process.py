@@ -13,49 +13,86 @@
 #   limitations under the License.
 
 
-import json
 import logging
 
 from arbiter.event.base import BaseEventHandler
 
 
 class ProcessEventHandler(BaseEventHandler):
-    def __init__(self, settings, subscriptions, state, process_id):
+    """ Consumer of ProcessWatcher, state is the dict of pending requests by request id """
+
+    def __init__(self, settings, subscriptions, state, process_id, minions=None):
         super().__init__(settings, subscriptions, state)
         self.process_id = process_id
+        self.minions = minions
+        self.channel = None
 
     def _connect_to_specific_queue(self, channel):
         channel.queue_declare(
-            queue=self.process_id, durable=True
+            queue=self.process_id, exclusive=True
         )
-        channel.basic_qos(prefetch_count=1)
         channel.basic_consume(
             queue=self.process_id,
-            on_message_callback=self.queue_event_callback
+            on_message_callback=self.queue_event_callback,
+            auto_ack=True
         )
+        if self.minions is not None:
+            channel.exchange_declare(
+                exchange=self.settings.heartbeat,
+                exchange_type="fanout", durable=True
+            )
+            heartbeat_queue = channel.queue_declare(queue="", exclusive=True)
+            channel.queue_bind(
+                exchange=self.settings.heartbeat,
+                queue=heartbeat_queue.method.queue
+            )
+            channel.basic_consume(
+                queue=heartbeat_queue.method.queue,
+                on_message_callback=self.heartbeat_callback,
+                auto_ack=True
+            )
+        self.channel = channel
         logging.info("[%s] Waiting for task events", self.ident)
         return channel
 
+    def heartbeat_callback(self, channel, method, properties, body):
+        _ = channel, method
+        try:
+            message = self.codec_for(properties).decode(body)
+            if message.get("minion_id"):  # heartbeats of older minions are not addressable
+                self.minions.update(message)
+                self._check_requests()
+        except:  # pylint: disable=W0702
+            logging.exception("[ProcessEvent] [Heartbeat] Got exception")
+
+    def _check_requests(self):
+        for request in list(self.state.values()):
+            request.check()
+
     def queue_event_callback(self, channel, method, properties, body):
         """ Process event """
         _ = properties, self, channel, method
         try:
-            logging.info(f"[ProcessHandler] {body}")
-            event = json.loads(body)
-            event_type = event.get("type", None)
+            logging.debug(f"[ProcessHandler] {body}")
+            event = self.codec_for(properties).decode(body)
+            event_type = event.pop("type", None)
             logging.info("[ProcessEvent] Type: %s", event_type)
             if event_type == "subscription_notification":
                 subscription = event.get("subscription")
                 if subscription in self.subscriptions:
                     self.subscriptions[subscription] = event.get("data")
+            if event_type == "state" and event.get("minion_id") and self.minions is not None:
+                self.minions.update(event)
+                self._check_requests()
             if event_type == "task_state":
-                event.pop("type")
-                for key, value in event.items():
-                    if not value and self.process_id in self.state and key not in self.state[self.process_id]["done"]:
-                        self.state[self.process_id]["done"].append(key)
-                    elif value and self.process_id in self.state and key not in self.state[self.process_id]["running"]:
-                        self.state[self.process_id]["running"].append(key)
-                logging.info(self.state)
+                request_id = event.pop("request_id", None)
+                minion_id = event.pop("minion_id", None)
+                if request_id is None:
+                    # minion w/o request ids, reply counts for every pending request
+                    requests = list(self.state.values())
+                else:
+                    requests = [self.state[request_id]] if request_id in self.state else []
+                for request in requests:
+                    request.add(event, minion_id)
         except:  # pylint: disable=W0702
             logging.exception("[ProcessEvent] Got exception")
-        channel.basic_ack(delivery_tag=method.delivery_tag)
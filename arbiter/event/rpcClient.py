@@ -16,9 +16,9 @@
 import pika
 from time import sleep
 from uuid import uuid4
-from json import loads, dumps
 import logging
 
+from arbiter.codec import properties_for
 from arbiter.event.base import BaseEventHandler
 
 
@@ -44,7 +44,7 @@ class RPCClintEventHandler(BaseEventHandler):
 
     def queue_event_callback(self, channel, method, properties, body):  # pylint: disable=R0912,R0915
         if self.correlation_id == properties.correlation_id:
-            self.response = body
+            self.response = self.codec_for(properties).decode(body)
 
     def call(self, tasks_module, task, args, kwargs):
         self.response = None
@@ -59,11 +59,12 @@ class RPCClintEventHandler(BaseEventHandler):
             self.client.basic_publish(
                 exchange='',
                 routing_key=tasks_module,
-                properties=pika.BasicProperties(
+                properties=pika.BasicProperties(**properties_for(
+                    self.settings.codec,
                     reply_to=self.callback_queue,
                     correlation_id=self.correlation_id,
-                ),
-                body=dumps(message).encode("utf-8"))
+                )),
+                body=self.settings.codec.encode(message))
         except (pika.exceptions.ConnectionClosedByBroker,
                 pika.exceptions.AMQPChannelError,
                 pika.exceptions.AMQPConnectionError,
@@ -74,7 +75,7 @@ class RPCClintEventHandler(BaseEventHandler):
             return self.call(tasks_module, task, args, kwargs)
         while self.response is None:
             self.client.connection.process_data_events()
-        resp = loads(self.response)
+        resp = self.response
         if resp.get("type") == "exception":
             raise ChildProcessError(resp["message"])
         return resp.get("message")
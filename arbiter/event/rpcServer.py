@@ -14,9 +14,9 @@
 
 
 import pika
-import json
 import logging
 from traceback import format_exc
+from arbiter.codec import properties_for
 from arbiter.event.base import BaseEventHandler
 
 
@@ -35,15 +35,17 @@ class RPCEventHandler(BaseEventHandler):
         return channel
 
     @staticmethod
-    def rpc_respond(channel, queue, body, correlation_id):
+    def rpc_respond(channel, queue, body, correlation_id, codec):
         channel.basic_publish(exchange='', routing_key=queue,
-                              body=json.dumps(body).encode("utf-8"),
-                              properties=pika.BasicProperties(
+                              body=codec.encode(body),
+                              properties=pika.BasicProperties(**properties_for(
+                                  codec,
                                   correlation_id=correlation_id
-                              ))
+                              )))
 
     def queue_event_callback(self, channel, method, properties, body):  # pylint: disable=R0912,R0915
-        event = json.loads(body)
+        codec = self.codec_for(properties)
+        event = codec.decode(body)
         try:
             logging.info("[%s] [RPCEvent]", self.ident)
             logging.info("[%s] [RPCEvent] Starting worker process", self.ident)
@@ -53,10 +55,10 @@ class RPCEventHandler(BaseEventHandler):
             logging.info("[%s] [TaskEvent] Worker process stopped", self.ident)
             self.rpc_respond(channel, properties.reply_to,
                              {"type": "result", "message": result, "task_key": event.get("task_key")},
-                             properties.correlation_id)
+                             properties.correlation_id, codec)
         except:
             logging.exception("[%s] [TaskEvent] Got exception", self.ident)
             self.rpc_respond(channel, properties.reply_to,
                              {"type": "exception", "message": format_exc(), "task_key": event.get("task_key")},
-                             properties.correlation_id)
+                             properties.correlation_id, codec)
         channel.basic_ack(delivery_tag=method.delivery_tag)
@@ -13,28 +13,49 @@
 #   limitations under the License.
 
 
-import json
 import logging
-import multiprocessing
+import threading
+from functools import partial
 from uuid import uuid4
 from traceback import format_exc
+from math import ceil
 from time import time
 
 from ..event.base import BaseEventHandler
+from ..blobs import BLOB_KEY, call_with_blobs, is_blob
+from ..executor import ProcessExecutor, map_chunk
 from ..tasks import ProcessWatcher
-
-mp = multiprocessing.get_context("spawn")
+from ..registry import capacity_message, change_active_workers
 
 
 class TaskEventHandler(BaseEventHandler):
-    def __init__(self, settings, subscriptions, state, task_registry, wait_time=2.0, pool_size=1):
+    def __init__(self, settings, subscriptions, state, task_registry, wait_time=2.0, pool_size=1, executor=None,
+                 prefetch=1, executors=None, task_executors=None, watcher=None):
         super().__init__(settings, subscriptions, state, wait_time=wait_time)
         self.pool_size = pool_size
+        self.prefetch = prefetch  # tasks in flight per consumer, acked once done
         self.task_registry = task_registry
-        self.pool = mp.Pool(pool_size)
+        # executors are normally shared by all handlers of a Minion
+        self.pool = executor if executor is not None else ProcessExecutor(pool_size, task_registry)
+        self.executors = executors if executors is not None else {"process": self.pool}
+        self.task_executors = task_executors if task_executors is not None else {}
+        self.watcher = watcher  # shared by handlers of a Minion, connects on first group callback
+
+    def get_watcher(self):
+        if self.watcher is None:
+            self.watcher = ProcessWatcher(f"{self.settings.queue}.watcher.{uuid4()}", self.settings.host,
+                                          self.settings.port, self.settings.user, self.settings.password,
+                                          vhost=self.settings.vhost, all_queue=self.settings.all,
+                                          wait_time=self.wait_time, use_ssl=self.settings.use_ssl,
+                                          ssl_verify=self.settings.ssl_verify, codec=self.settings.codec)
+        return self.watcher
+
+    def executor_for(self, task_name):
+        """ Executor of the task: process (default), thread or inline """
+        return self.executors.get(self.task_executors.get(task_name), self.pool)
 
     def _connect_to_specific_queue(self, channel):
-        channel.basic_qos(prefetch_count=1)
+        channel.basic_qos(prefetch_count=self.prefetch)
         channel.basic_consume(
             queue=self.settings.queue,
             on_message_callback=self.queue_event_callback
@@ -44,94 +65,186 @@ class TaskEventHandler(BaseEventHandler):
 
     def queue_event_callback(self, channel, method, properties, body):  # pylint: disable=R0912,R0915
         _ = properties, self, channel, method
-        event = json.loads(body)
+        codec = self.codec_for(properties)
+        event = codec.decode(body)
+        active = True
+        change_active_workers(self.state, 1)
         try:
-            self.state["active_workers"] += 1
             # new tasks will be w/o key testing purpose only
             # do not use in prod implementation
             if not event.get("task_key"):
-                event["task_key"] = uuid4()
+                event["task_key"] = str(uuid4())
             event_type = event.get("type", "task")
             logging.info("[%s] [TaskEvent] Type: %s", self.ident, event_type)
             if event_type == "task":
                 if event.get("arbiter"):
                     self.respond(channel, {"type": "task_state_change", "task_key": event.get("task_key"),
-                                           "task_state": "running"}, event.get("arbiter"))
+                                           "task_state": "running"}, event.get("arbiter"), codec=codec)
                 logging.info("[%s] [TaskEvent] Starting worker process", self.ident)
                 if event.get("task_name") not in self.task_registry:
                     raise ModuleNotFoundError("Task is not a part of this worker")
-                worker = self.pool.apply_async(self.task_registry[event.get("task_name")],
-                                               event.get("args", []),
-                                               event.get("kwargs", {}))
+                executor = self.executor_for(event.get("task_name"))
+                func = self.task_registry[event.get("task_name")]
+                if event.get("map"):
+                    func = partial(map_chunk, func)  # whole chunk is one pool call
+                stream = {}
+                if event.get("stream") and event.get("arbiter"):
+                    stream = {"on_chunk": partial(self._on_task_chunk, channel, event, codec),
+                              "window": event.get("stream")}
+                if self.settings.blob_store is not None:
+                    worker = executor.submit(call_with_blobs, (
+                        func, event.get("args", []), event.get("kwargs", {}),
+                        self.settings.blob_store, codec.name, self.settings.blob_threshold
+                    ), task_key=event.get("task_key"), **stream)
+                else:
+                    worker = executor.submit(func, event.get("args", []), event.get("kwargs", {}),
+                                             task_key=event.get("task_key"), **stream)
                 self.state[event.get("task_key")] = {
                     "process": worker,
                     "status": "running"
                 }
-                while not worker.ready():
-                    if self.state[event.get('task_key')]["status"] == "canceled":
-                        self.pool.close()
-                        self.pool.terminate()
-                        self.pool.join()
-                        self.pool = mp.Pool(self.pool_size)
-                        break
-                    channel._connection.sleep(1.0)  # pylint: disable=W0212
-
-                result = worker.get() if self.state[event.get('task_key')]["status"] != "canceled" else "canceled"
-                logging.info("[%s] [TaskEvent] Worker process stopped", self.ident)
-                if event.get("arbiter"):
-                    self.respond(channel, {"type": "task_state_change", "task_key": event.get("task_key"),
-                                           "result": result, "task_state": "done"}, event.get("arbiter"))
-                self.state[event.get('task_key')]["status"] = "done"
-                if not event.get("callback", False):
-                    self.state.pop(event.get("task_key"))
+                # cancelled tasks are terminated by GlobalEventHandler, done callback is called either way
+                worker.add_done_callback(partial(self._on_task_done, channel, method, event, codec))
+                return  # consumer is free for next message, this one is acked once the task is done
 
             elif event_type == "callback":
                 callback_key = event.get("task_key")
-                minibitter = ProcessWatcher(callback_key, self.settings.host, self.settings.port, self.settings.user,
-                                            self.settings.password, vhost=self.settings.vhost, wait_time=self.wait_time)
-                state = minibitter.collect_state(event.get("tasks_array"))
+                watcher = self.get_watcher()
+                state = watcher.collect_state([task for task in event.get("tasks_array") if task != callback_key])
                 if all(task in state.get("done", []) for task in event.get("tasks_array") if task != callback_key):
                     if not event.get("callback", False):
-                        minibitter.clear_state(event.get("tasks_array"))
+                        watcher.clear_state(event.get("tasks_array"))
                         event.pop("tasks_array")
                     event["type"] = "task"
-                    minibitter.close()
-                    self.respond(channel, event, self.settings.queue)
+                    self.respond(channel, event, self.settings.queue, codec=codec, priority=event.get("priority"))
                 else:
                     logging.info("********************************************")
                     logging.info("Callback: waiting till all tasks are done")
                     logging.info("********************************************")
-                    minibitter.close()
-                    self.respond(channel, event, self.settings.queue, 60)
+                    self.respond(channel, event, self.settings.queue, 60, codec=codec, priority=event.get("priority"))
             elif event_type == "finalize":
                 if event.get("timeout") != -1:
-                    timeout = True if int(time()) - int(event.get("start_time")) > int(event.get("timeout")) else False
+                    timeout = time() - float(event.get("start_time")) >= int(event.get("timeout"))
                 else:
                     timeout = False
-                finalizer_key = event.get("task_key")
-                minibitter = ProcessWatcher(finalizer_key, self.settings.host, self.settings.port, self.settings.user,
-                                            self.settings.password, vhost=self.settings.vhost, wait_time=self.wait_time)
-                state = minibitter.collect_state(event.get("tasks_array"))
+                watcher = self.get_watcher()
+                state = watcher.collect_state(event.get("tasks_array"))
                 if timeout:
                     logging.info("********************************************")
                     logging.info(f"Timeout: {event.get('timeout')} sec")
                     logging.info("********************************************")
                 if all(task in state.get("done", []) for task in event.get("tasks_array")) or timeout:
                     event["type"] = "task"
-                    minibitter.clear_state(event.get("tasks_array"))
-                    minibitter.close()
+                    watcher.clear_state(event.get("tasks_array"))
                     event.pop("tasks_array")
-                    self.respond(channel, event, self.settings.queue)
+                    self.respond(channel, event, self.settings.queue, codec=codec, priority=event.get("priority"))
                 else:
-                    minibitter.close()
                     logging.info("********************************************")
                     logging.info("Finalizer: waiting till all tasks are done")
                     logging.info("********************************************")
-                    self.respond(channel, event, self.settings.queue, 10)
+                    delay = 10
+                    if event.get("timeout") != -1:
+                        # re-check right at the deadline instead of up to 10 sec after it
+                        remaining = float(event.get("start_time")) + int(event.get("timeout")) - time()
+                        delay = min(delay, max(ceil(remaining), 1))
+                    self.respond(channel, event, self.settings.queue, delay, codec=codec,
+                                 priority=event.get("priority"))
         except:
             logging.exception("[%s] [TaskEvent] Got exception", self.ident)
+            if active:
+                change_active_workers(self.state, -1)
+                active = False
             if event.get("arbiter"):
                 self.respond(channel, {"type": "task_state_change", "task_key": event.get("task_key"),
-                                       "result": format_exc(), "task_state": "exception"}, event.get("arbiter"))
-        self.state["active_workers"] -= 1
+                                       "result": format_exc(), "task_state": "exception",
+                                       "capacity": capacity_message(self.state)}, event.get("arbiter"), codec=codec)
+        if active:
+            change_active_workers(self.state, -1)
         channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _in_consumer(self, channel, callback):
+        """ Run callback in consumer thread, pika channels are not thread-safe """
+        if threading.current_thread() is self:
+            callback()  # inline executor
+        else:
+            channel.connection.add_callback_threadsafe(callback)
+
+    def _on_task_chunk(self, channel, event, codec, chunk):
+        """ Called in executor thread for every chunk of streaming task """
+        self._in_consumer(channel, partial(
+            self.respond, channel, {"type": "task_chunk", "task_key": event.get("task_key"), "chunk": chunk,
+                                    "reply_to": self.state.get("global_queue")},
+            event.get("arbiter"), codec=codec
+        ))
+
+    def _on_task_done(self, channel, method, event, codec, worker):
+        """ Called in executor thread, reporting is moved to consumer thread """
+        try:
+            self._in_consumer(channel, partial(self._task_done, channel, method, event, codec, worker))
+        except:  # pylint: disable=W0702
+            logging.exception("[%s] [TaskEvent] Failed to report task %s", self.ident, event.get("task_key"))
+            change_active_workers(self.state, -1)
+
+    def _forward(self, channel, chain, result, codec):
+        """ Publish next stage of chained pipe with result of this one as upstream kwarg """
+        stage = dict(chain[0], chain=chain[1:])
+        stage["kwargs"] = dict(stage.get("kwargs") or {}, upstream=result)
+        self.respond(channel, stage, stage.get("queue"), codec=codec, priority=stage.get("priority"))
+
+    def _task_done(self, channel, method, event, codec, worker):
+        try:
+            result = "canceled" if worker.cancelled else worker.get()
+            task_state = "done"
+        except:  # pylint: disable=W0702
+            logging.exception("[%s] [TaskEvent] Got exception", self.ident)
+            result = format_exc()
+            task_state = "exception"
+        logging.info("[%s] [TaskEvent] Worker process stopped", self.ident)
+        if event.get("task_key") in self.state:
+            self.state[event.get("task_key")]["status"] = "done"
+        # capacity is released before reporting, so arbiter never sees done task as still active
+        change_active_workers(self.state, -1)
+        forwarded = False
+        if event.get("chain") and task_state == "done" and not worker.cancelled:
+            try:
+                self._forward(channel, event.get("chain"), result, codec)
+                forwarded = True
+            except:  # pylint: disable=W0702
+                logging.exception("[%s] [TaskEvent] Failed to forward result of %s", self.ident, event.get("task_key"))
+                result = format_exc()
+                task_state = "exception"
+        try:
+            if event.get("arbiter"):
+                message = {"type": "task_state_change", "task_key": event.get("task_key"),
+                           "task_state": task_state, "capacity": capacity_message(self.state)}
+                if not forwarded:  # result of chained pipe stage goes to the next stage only
+                    message["result"] = result
+                self.respond(channel, message, event.get("arbiter"), codec=codec)
+        except:  # pylint: disable=W0702
+            # e.g. result codec can not encode, arbiter still has to learn the task is over
+            logging.exception("[%s] [TaskEvent] Failed to report task %s", self.ident, event.get("task_key"))
+            self._report_exception(channel, event, codec, format_exc())
+        finally:
+            if not event.get("callback", False):
+                self.state.pop(event.get("task_key"), None)
+            try:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                self._discard_upstream(event)
+            except:  # pylint: disable=W0702
+                logging.exception("[%s] [TaskEvent] Failed to ack task %s", self.ident, event.get("task_key"))
+
+    def _report_exception(self, channel, event, codec, error):
+        if not event.get("arbiter"):
+            return
+        try:
+            self.respond(channel, {"type": "task_state_change", "task_key": event.get("task_key"),
+                                   "result": error, "task_state": "exception",
+                                   "capacity": capacity_message(self.state)}, event.get("arbiter"), codec=codec)
+        except:  # pylint: disable=W0702
+            logging.exception("[%s] [TaskEvent] Failed to report task %s", self.ident, event.get("task_key"))
+
+    def _discard_upstream(self, event):
+        """ Blob forwarded by previous chained pipe stage is kept till this stage is acked, for redelivery """
+        upstream = (event.get("kwargs") or {}).get("upstream")
+        if self.settings.blob_store is not None and is_blob(upstream):
+            self.settings.blob_store.delete(upstream[BLOB_KEY])
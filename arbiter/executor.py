@@ -0,0 +1,530 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Minion-wide task executors
+
+    One executor of each kind is shared by all TaskEventHandler threads of a Minion:
+    process (default, isolated warm worker processes), thread (bounded thread pool for
+    I/O-bound tasks) and inline (runs in consumer thread). Each worker process has its
+    own pipe, so a single task can be cancelled by terminating just the process running it
+"""
+
+import inspect
+import logging
+import threading
+import importlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from multiprocessing.pool import ExceptionWithTraceback
+
+EXECUTORS = ("process", "thread", "inline")
+
+
+class _Closing(Exception):
+    """ Executor was closed while streaming task waited for credit """
+
+
+def collect_result(result, window=None, emit=None, wait_credit=None):
+    """
+    Result of generator task: with window its chunks are emitted while credit allows
+    (window chunks ahead of consumer, unbounded w/o wait_credit), otherwise they are collected into a list
+    """
+    if not inspect.isgenerator(result):
+        return result
+    if window is None:
+        return list(result)
+    credit = window
+    while True:
+        while wait_credit is not None and credit <= 0:
+            credit += wait_credit()
+        try:
+            chunk = next(result)
+        except StopIteration as stop:
+            return stop.value
+        emit(chunk)
+        credit -= 1
+
+
+def map_chunk(func, *items, **kwargs):
+    """ Chunk of Arbiter.map run as one pool call, results are in order of items """
+    return [collect_result(func(item, **kwargs)) for item in items]
+
+
+def _wait_credit(conn):
+    while True:
+        message = conn.recv()
+        if message is None:
+            raise _Closing()
+        if isinstance(message, int):
+            return message
+
+
+def _worker_main(conn, modules, max_tasks):
+    """ Worker process loop: (func, args, kwargs, window) in, (success, value) out, (None, chunk) for streams """
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except:  # pylint: disable=W0702
+            logging.exception("Failed to preload %s", module)
+    completed = 0
+    while max_tasks is None or completed < max_tasks:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        if isinstance(message, int):
+            continue  # late credit of a finished stream
+        func, args, kwargs, window = message
+        try:
+            result = (True, collect_result(func(*args, **kwargs), window,
+                                           lambda chunk: conn.send((None, chunk)), lambda: _wait_credit(conn)))
+        except _Closing:
+            break
+        except BaseException as exc:  # pylint: disable=W0703
+            result = (False, ExceptionWithTraceback(exc, exc.__traceback__))
+        try:
+            conn.send(result)
+        except Exception as exc:  # pylint: disable=W0703
+            conn.send((False, ExceptionWithTraceback(exc, exc.__traceback__)))
+        completed += 1
+    conn.close()
+
+
+class CancelledTask(Exception):
+    """ Value of a cancelled task handle """
+
+
+class TaskHandle:
+    """ Result of a task submitted to ProcessExecutor, similar to multiprocessing AsyncResult """
+
+    def __init__(self, executor, task_key=None, on_chunk=None):
+        self.executor = executor
+        self.task_key = task_key
+        self.on_chunk = on_chunk  # called with every chunk of streaming (generator) task
+        self.cancelled = False
+        self._credit = threading.Semaphore(0)
+        self._success = None
+        self._value = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        return self.ready() and self._success
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError(f"Task {self.task_key} is not done after {timeout} sec")
+        if not self._success:
+            raise self._value
+        return self._value
+
+    def cancel(self):
+        """ Terminate the task, returns False if it was already done """
+        return self.executor.cancel(self)
+
+    def grant(self, credit):
+        """ Allow streaming task to produce `credit` more chunks """
+        return self.executor.grant(self, credit)
+
+    def _chunk(self, chunk):
+        if self.on_chunk is None:
+            return
+        try:
+            self.on_chunk(chunk)
+        except:  # pylint: disable=W0702
+            logging.exception("[TaskHandle] Chunk callback failed for %s", self.task_key)
+
+    def _wait_credit(self):
+        self._credit.acquire()  # pylint: disable=R1732
+        return 1
+
+    def add_done_callback(self, callback):
+        """ Callback is called with this handle once task is done (in executor thread) """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def _resolve(self, success, value):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._success = success
+            self._value = value
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+        return True
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except:  # pylint: disable=W0702
+            logging.exception("[TaskHandle] Done callback failed for %s", self.task_key)
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "handle", "completed", "retired")
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.handle = None
+        self.completed = 0
+        self.retired = False
+
+
+class ProcessExecutor:
+    """
+    Fixed-size set of warm worker processes
+
+    Task modules are imported by workers at start (preload), workers are replaced
+    after max_tasks_per_child tasks, when they die or when their task is cancelled.
+    Replacements come from a few warm spare processes, refilled in background.
+
+    With start_method="forkserver" task modules (and the main module) are preloaded
+    into the fork server, so every new worker is forked from an already warm template
+    """
+
+    def __init__(self, size, task_registry=None, max_tasks_per_child=None, start_method="spawn", preload=True,
+                 spare=1):
+        self.size = size
+        self.spare = spare
+        self.max_tasks_per_child = max_tasks_per_child
+        self.context = multiprocessing.get_context(start_method)
+        self.modules = self.preload_modules(task_registry) if preload else []
+        if start_method == "forkserver" and preload:
+            # takes effect only if fork server of this process is not running yet
+            self.context.set_forkserver_preload(["__main__", __name__] + self.modules)
+        self.lock = threading.RLock()
+        self.workers = []
+        self.spares = []
+        self.pending = deque()
+        self.closed = False
+        self._refilling = False
+        self._wakeup_reader, self._wakeup_writer = multiprocessing.Pipe(duplex=False)
+        for _ in range(size):
+            self.workers.append(self._start_worker())
+        self._start_refill()
+        self._collector = threading.Thread(target=self._collect, name="ProcessExecutor", daemon=True)
+        self._collector.start()
+
+    @staticmethod
+    def preload_modules(task_registry):
+        """ Modules of registered tasks; __main__ is re-imported by spawn itself """
+        modules = {getattr(func, "__module__", None) for func in (task_registry or {}).values()}
+        return sorted(module for module in modules if module and module not in ("__main__", "__mp_main__"))
+
+    def submit(self, func, args=None, kwargs=None, task_key=None, on_chunk=None, window=None):
+        """
+        Run func(*args, **kwargs) in a worker process, returns TaskHandle
+        Chunks of generator task are passed to on_chunk, `window` ahead of granted credit
+        """
+        handle = TaskHandle(self, task_key, on_chunk)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Executor is closed")
+            self.pending.append((handle, (func, list(args or []), dict(kwargs or {}), window)))
+            self._dispatch()
+        return handle
+
+    def grant(self, handle, credit):
+        with self.lock:
+            worker = next((each for each in self.workers if each.handle is handle), None)
+            if worker is None:
+                return False
+            try:
+                worker.conn.send(credit)
+            except (OSError, ValueError):
+                return False
+        return True
+
+    def cancel(self, handle):
+        with self.lock:
+            for item in self.pending:
+                if item[0] is handle:
+                    self.pending.remove(item)
+                    break
+            else:
+                worker = next((each for each in self.workers if each.handle is handle), None)
+                if worker is None:
+                    return False
+                self._retire(worker)
+                worker.process.terminate()
+            handle.cancelled = True
+        logging.info("[ProcessExecutor] Task %s cancelled", handle.task_key)
+        return handle._resolve(False, CancelledTask(handle.task_key))  # pylint: disable=W0212
+
+    def close(self, timeout=10):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, deque()
+            workers = self.workers + self.spares
+            self.spares = []
+        for handle, _ in pending:
+            handle._resolve(False, CancelledTask(handle.task_key))  # pylint: disable=W0212
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+        self._wake()
+        self._collector.join(timeout)
+
+    def _start_worker(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child_conn, self.modules, self.max_tasks_per_child),
+                                       daemon=True)
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    def _replace(self):
+        """ Promote a warm spare in place of a gone worker, new process is started only if there is none """
+        while self.spares:
+            worker = self.spares.pop(0)
+            if worker.process.is_alive():
+                break
+            worker.conn.close()
+        else:
+            worker = self._start_worker()
+        self.workers.append(worker)
+        self._dispatch()
+        self._start_refill()
+
+    def _start_refill(self):
+        if self.spare and not self._refilling and len(self.spares) < self.spare:
+            self._refilling = True
+            threading.Thread(target=self._refill, name="ProcessExecutorRefill", daemon=True).start()
+
+    def _refill(self):
+        while True:
+            with self.lock:
+                if self.closed or len(self.spares) >= self.spare:
+                    self._refilling = False
+                    return
+            worker = self._start_worker()  # outside of lock, dispatch is not blocked by process start
+            with self.lock:
+                if not self.closed:
+                    self.spares.append(worker)
+                    continue
+            worker.conn.send(None)
+            worker.process.join()
+
+    def _retire(self, worker):
+        """ Worker is replaced right away, collector joins it once its process exits """
+        worker.retired = True
+        worker.handle = None
+        if not self.closed:
+            self._replace()
+        self._wake()
+
+    def _dispatch(self):
+        for worker in self.workers:
+            if not self.pending:
+                return
+            if worker.handle is not None or worker.retired:
+                continue
+            handle, message = self.pending[0]
+            try:
+                worker.conn.send(message)
+            except (OSError, EOFError):
+                continue  # dead worker, collector replaces it
+            except Exception as exc:  # pylint: disable=W0703
+                self.pending.popleft()
+                handle._resolve(False, exc)  # pylint: disable=W0212
+                continue
+            self.pending.popleft()
+            worker.handle = handle
+            self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_writer.send(None)
+        except (OSError, ValueError):
+            pass
+
+    def _collect(self):
+        while True:
+            with self.lock:
+                if self.closed and not any(worker.process.is_alive() for worker in self.workers):
+                    return
+                waitables = {self._wakeup_reader: None}
+                for worker in self.workers:
+                    waitables[worker.process.sentinel] = worker
+                    if worker.handle is not None:
+                        waitables[worker.conn] = worker
+            ready = wait(list(waitables))
+            if self._wakeup_reader in ready:
+                while self._wakeup_reader.poll():
+                    self._wakeup_reader.recv()
+            for each in ready:
+                if waitables[each] is not None and each is waitables[each].conn:
+                    self._on_result(waitables[each])
+            for each in ready:
+                if waitables[each] is not None and each == waitables[each].process.sentinel:
+                    self._on_exit(waitables[each])
+
+    def _on_result(self, worker):
+        """ Handle one message of worker, returns False when its pipe is closed """
+        try:
+            success, value = worker.conn.recv()
+        except (EOFError, OSError):
+            return False  # process died, handled by _on_exit
+        if success is None:
+            if worker.handle is not None:
+                worker.handle._chunk(value)  # pylint: disable=W0212
+            return True
+        with self.lock:
+            handle, worker.handle = worker.handle, None
+            worker.completed += 1
+            if self.max_tasks_per_child and worker.completed >= self.max_tasks_per_child:
+                self._retire(worker)
+            else:
+                self._dispatch()
+        if handle is not None:
+            handle._resolve(success, value)  # pylint: disable=W0212
+        return True
+
+    def _on_exit(self, worker):
+        try:
+            # trailing chunks and result sent right before exit (max_tasks_per_child)
+            while worker.handle is not None and worker.conn.poll():
+                if not self._on_result(worker):
+                    break
+        except (EOFError, OSError):
+            pass
+        worker.process.join()
+        worker.conn.close()
+        with self.lock:
+            if worker not in self.workers:
+                return
+            self.workers.remove(worker)
+            handle = worker.handle
+            if not worker.retired and not self.closed:
+                logging.warning("[ProcessExecutor] Worker %s exited with %s", worker.process.pid,
+                                worker.process.exitcode)
+                worker.handle = None
+                self._replace()
+        if handle is not None:
+            handle._resolve(False, ChildProcessError(  # pylint: disable=W0212
+                f"Worker process exited with code {worker.process.exitcode}"))
+
+
+class ThreadExecutor:
+    """ Bounded thread pool, no pickling of args and results; running tasks can not be cancelled """
+
+    def __init__(self, size):
+        self.size = size
+        self.pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix="TaskThread")
+        self.futures = dict()  # handle -> future
+
+    def submit(self, func, args=None, kwargs=None, task_key=None, on_chunk=None, window=None):
+        handle = TaskHandle(self, task_key, on_chunk)
+        future = self.pool.submit(_call, handle, func, args, kwargs, window)
+        self.futures[handle] = future
+        future.add_done_callback(lambda _: self._done(handle, future))
+        return handle
+
+    def _done(self, handle, future):
+        self.futures.pop(handle, None)
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is not None:
+            handle._resolve(False, exception)  # pylint: disable=W0212
+        else:
+            handle._resolve(True, future.result())  # pylint: disable=W0212
+
+    @staticmethod
+    def grant(handle, credit):
+        for _ in range(credit):  # Semaphore.release(n) is 3.9+
+            handle._credit.release()  # pylint: disable=W0212
+        return True
+
+    def cancel(self, handle):
+        future = self.futures.get(handle)
+        if future is None or not future.cancel():
+            logging.warning("[ThreadExecutor] Task %s is running in thread and can not be cancelled", handle.task_key)
+            return False
+        handle.cancelled = True
+        return handle._resolve(False, CancelledTask(handle.task_key))  # pylint: disable=W0212
+
+    def close(self, timeout=None):
+        _ = timeout
+        self.pool.shutdown(wait=False)
+
+
+class InlineExecutor:
+    """ Runs task right in the calling (consumer) thread, for short tasks only """
+
+    def submit(self, func, args=None, kwargs=None, task_key=None, on_chunk=None, window=None):
+        handle = TaskHandle(self, task_key, on_chunk)
+        try:
+            # consumer thread can not wait for credit, chunks are sent as produced
+            result = collect_result(func(*(args or []), **(kwargs or {})), window, handle._chunk)  # pylint: disable=W0212
+        except Exception as exc:  # pylint: disable=W0703
+            handle._resolve(False, exc)  # pylint: disable=W0212
+        else:
+            handle._resolve(True, result)  # pylint: disable=W0212
+        return handle
+
+    @staticmethod
+    def cancel(handle):
+        _ = handle
+        return False
+
+    @staticmethod
+    def grant(handle, credit):
+        _ = handle, credit
+        return False
+
+    def close(self, timeout=None):
+        pass
+
+
+def _call(handle, func, args, kwargs, window):
+    """ Task call in thread, streams wait for credit on handle """
+    return collect_result(func(*(args or []), **(kwargs or {})), window,
+                          handle._chunk, handle._wait_credit)  # pylint: disable=W0212
+
+
+def create_executor(kind, size, task_registry=None, **kwargs):
+    """ Executor by kind: process, thread or inline """
+    if kind == "process":
+        return ProcessExecutor(size, task_registry, **kwargs)
+    if kind == "thread":
+        return ThreadExecutor(size)
+    if kind == "inline":
+        return InlineExecutor()
+    raise ValueError(f"Unknown executor: {kind}, expected one of {EXECUTORS}")
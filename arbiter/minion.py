@@ -14,19 +14,29 @@
 
 
 import logging
+import threading
+from uuid import uuid4
 
 from .base import Base
 from .event.task import TaskEventHandler
 from .event.broadcast import GlobalEventHandler
 from .event.rpcServer import RPCEventHandler
+from .executor import EXECUTORS, create_executor
+from .tasks import ProcessWatcher
 from .task import Task
 
 
 class Minion(Base):
-    def __init__(self, host, port, user, password, vhost="carrier", queue="default", all_queue="arbiterAll", use_ssl=False, ssl_verify=False):
-        super().__init__(host, port, user, password, vhost, queue, all_queue, use_ssl=use_ssl, ssl_verify=ssl_verify)
+    def __init__(self, host, port, user, password, vhost="carrier", queue="default", all_queue="arbiterAll", use_ssl=False, ssl_verify=False, pool_size=4, codec=None,
+                 blob_store=None, blob_threshold=1024 * 1024, max_priority=None):
+        super().__init__(host, port, user, password, vhost, queue, all_queue, use_ssl=use_ssl, ssl_verify=ssl_verify,
+                         pool_size=pool_size, codec=codec, blob_store=blob_store, blob_threshold=blob_threshold,
+                         max_priority=max_priority)
         self.task_registry = {}
+        self.task_executors = {}  # task name -> executor kind, when set in decorator
         self.task_handlers = []
+        self.executor = None
+        self.executors = {}
 
     def apply(self, task_name, queue=None, tasks_count=1, task_args=None, task_kwargs=None, sync=True):
         task = Task(task_name, queue=queue if queue else self.config.queue,
@@ -46,10 +56,14 @@ class Minion(Base):
             raise TypeError('@task decorated function must be callable')
         return inner_task
 
-    def _create_task_from_callable(self, func, name=None, **kwargs):
+    def _create_task_from_callable(self, func, name=None, executor=None, **kwargs):
         name = name if name else f"{func.__name__}.{func.__module__}"
+        if executor is not None and executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor: {executor}, expected one of {EXECUTORS}")
         if name not in self.task_registry:
             self.task_registry[name] = func
+            if executor is not None:
+                self.task_executors[name] = executor
         return self.task_registry[name]
 
     def rpc(self, workers, blocking=False):
@@ -67,17 +81,49 @@ class Minion(Base):
             for prcsrs in self.task_handlers:
                 prcsrs.join()
 
-    def run(self, workers):
+    def run(self, workers, heartbeat_interval=2.0, max_tasks_per_child=None, prefetch=1, start_method="spawn",
+            executor="process"):
+        """
+        Start consuming with `workers` task slots
+        With prefetch > 1 every consumer thread keeps up to `prefetch` tasks in flight,
+        start_method is the one of worker processes: spawn (default), forkserver or fork,
+        executor is the default one for tasks registered without it: process, thread or inline
+        """
         state = dict()
         subscriptions = dict()
         logging.info("Starting '%s' worker", self.config.queue)
         # Listen for task events
         state["queue"] = self.config.queue
+        state["minion_id"] = str(uuid4())
         state["total_workers"] = workers
         state["active_workers"] = 0
-        for _ in range(workers):
-            TaskEventHandler(self.config, subscriptions, state, self.task_registry, wait_time=self.wait_time).start()
+        state["seq"] = 0
+        state["heartbeat_interval"] = heartbeat_interval
+        state["lock"] = threading.Lock()
+        # One executor of each used kind shared by all task handlers
+        task_executors = {name: self.task_executors.get(name, executor) for name in self.task_registry}
+        for kind in set(task_executors.values()) | {executor}:
+            options = {}
+            if kind == "process":
+                options = dict(max_tasks_per_child=max_tasks_per_child, start_method=start_method)
+            self.executors[kind] = create_executor(kind, workers, self.task_registry, **options)
+        self.executor = self.executors[executor]
+        watcher = ProcessWatcher(f"{self.config.queue}.watcher.{state['minion_id']}", self.config.host,
+                                 self.config.port, self.config.user, self.config.password, vhost=self.config.vhost,
+                                 all_queue=self.config.all, wait_time=self.wait_time, use_ssl=self.config.use_ssl,
+                                 ssl_verify=self.config.ssl_verify, codec=self.config.codec)
+        for slots in range(workers, 0, -prefetch):
+            TaskEventHandler(self.config, subscriptions, state, self.task_registry, wait_time=self.wait_time,
+                             executor=self.executor, prefetch=min(prefetch, slots),
+                             executors=self.executors, task_executors=task_executors, watcher=watcher).start()
         # Listen for global events
         global_handler = GlobalEventHandler(self.config, subscriptions, state)
         global_handler.start()
-        global_handler.join()
+        try:
+            global_handler.join()
+            if global_handler.error is not None:
+                raise global_handler.error
+        finally:
+            watcher.close()
+            for each in self.executors.values():
+                each.close()
@@ -0,0 +1,211 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import logging
+import threading
+from contextlib import contextmanager
+
+import pika
+
+CONNECTION_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.AMQPChannelError,
+    pika.exceptions.StreamLostError,
+    pika.exceptions.ConnectionClosedByBroker,
+)
+
+
+class PooledChannel:
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+        self.tx_channel = None
+
+    def get_tx_channel(self):
+        """ Separate channel in transaction mode, used for batches """
+        if self.tx_channel is None or not self.tx_channel.is_open:
+            self.tx_channel = self.connection.channel()
+            self.tx_channel.tx_select()
+        return self.tx_channel
+
+    @property
+    def is_open(self):
+        return self.connection.is_open and self.channel.is_open
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except:  # pylint: disable=W0702
+            pass
+
+
+class ChannelPool:
+    """
+    Bounded pool of publisher connections, each checked out by one thread at a time
+
+    Idle connections are kept alive (and dropped when broken) by a checker thread,
+    so publishing does not pay for a broker round-trip on every message
+    """
+
+    def __init__(self, create, prepare=None, max_size=4, check_interval=10.0):
+        self.create = create
+        self.prepare = prepare
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.idle = []  # most recently used last
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)  # notified when idle item or free slot appears
+        self.local = threading.local()
+        self.size = 0
+        self.stop_event = threading.Event()
+        self.checker = None
+
+    @contextmanager
+    def channel(self):
+        """ Check out a channel for the current thread, reentrant within the thread """
+        with self.connection() as item:
+            yield item.channel
+
+    @contextmanager
+    def connection(self):
+        """ Check out a PooledChannel for the current thread, reentrant within the thread """
+        held = getattr(self.local, "item", None)
+        if held is not None:
+            yield held
+            return
+        item = self._checkout()
+        self.local.item = item
+        try:
+            yield item
+        except CONNECTION_ERRORS:
+            self._discard(item)
+            item = None
+            raise
+        finally:
+            self.local.item = None
+            if item is not None:
+                self._checkin(item)
+
+    def publish(self, **kwargs):
+        """ basic_publish through a pooled channel, retried once on a fresh connection """
+        try:
+            with self.channel() as channel:
+                channel.basic_publish(**kwargs)
+        except CONNECTION_ERRORS:
+            logging.info("[ChannelPool] Publishing failed, reconnecting")
+            with self.channel() as channel:
+                channel.basic_publish(**kwargs)
+
+    def publish_batch(self, exchange, routing_key, bodies, properties):
+        """
+        Publish all bodies down one channel as a single transaction
+
+        Broker acknowledges the whole batch once on commit, and nothing is delivered
+        if connection breaks in the middle, so the batch is retried once as a whole
+        """
+        bodies = list(bodies)
+        try:
+            self._publish_batch(exchange, routing_key, bodies, properties)
+        except CONNECTION_ERRORS:
+            logging.info("[ChannelPool] Batch publishing failed, reconnecting")
+            self._publish_batch(exchange, routing_key, bodies, properties)
+
+    def _publish_batch(self, exchange, routing_key, bodies, properties):
+        with self.connection() as item:
+            channel = item.get_tx_channel()
+            for body in bodies:
+                channel.basic_publish(
+                    exchange=exchange, routing_key=routing_key,
+                    body=body, properties=properties
+                )
+            channel.tx_commit()
+
+    def close(self):
+        """ Close idle connections, pool can be used again afterwards """
+        self.stop_event.set()
+        for item in self._take_idle():
+            self._discard(item)
+        with self.lock:
+            self.checker = None
+            self.stop_event = threading.Event()
+
+    def _checkout(self):
+        self._start_checker()
+        while True:
+            with self.available:
+                while not self.idle and self.size >= self.max_size:
+                    self.available.wait()
+                item = self.idle.pop() if self.idle else None
+                if item is None:
+                    self.size += 1
+            if item is None:
+                try:
+                    return self._create()
+                except:
+                    with self.available:
+                        self.size -= 1
+                        self.available.notify()
+                    raise
+            if item.is_open:
+                return item
+            self._discard(item)
+
+    def _checkin(self, item):
+        if item.is_open:
+            with self.available:
+                self.idle.append(item)
+                self.available.notify()
+        else:
+            self._discard(item)
+
+    def _discard(self, item):
+        """ Close item, its slot is free for a waiting thread to create new connection """
+        item.close()
+        with self.available:
+            self.size -= 1
+            self.available.notify()
+
+    def _take_idle(self):
+        with self.lock:
+            items, self.idle = self.idle, []
+        return items
+
+    def _create(self):
+        connection = self.create()
+        channel = connection.channel()
+        if self.prepare:
+            self.prepare(channel)
+        return PooledChannel(connection, channel)
+
+    def _start_checker(self):
+        if self.checker is not None or not self.check_interval:
+            return
+        with self.lock:
+            if self.checker is None:
+                self.checker = threading.Thread(target=self._check_idle, args=(self.stop_event,), daemon=True)
+                self.checker.start()
+
+    def _check_idle(self, stop_event):
+        """ Service heartbeats of idle connections and drop the broken ones """
+        while not stop_event.wait(self.check_interval):
+            for item in self._take_idle():
+                try:
+                    item.connection.process_data_events(time_limit=0)
+                except:  # pylint: disable=W0702
+                    logging.info("[ChannelPool] Dropping broken idle connection")
+                    self._discard(item)
+                    continue
+                self._checkin(item)
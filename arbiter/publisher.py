@@ -0,0 +1,167 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+import pika
+
+
+class DeliveryError(Exception):
+    """ Message was nacked by broker more times than allowed """
+
+
+class Delivery:
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.attempts = 0
+        self.future = Future()
+
+
+class ConfirmPublisher(threading.Thread):
+    """
+    Publisher with broker confirms and many messages in flight
+
+    Runs pika SelectConnection in own thread. Every publish returns a Future resolved
+    on broker ack; nacked messages are retried up to max_retries times, and messages
+    in flight during connection loss are published again after reconnect (at-least-once)
+    """
+
+    def __init__(self, get_parameters, max_retries=3, max_in_flight=1000, retry_interval=3.0):
+        super().__init__(daemon=True)
+        self.get_parameters = get_parameters
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self.retry_interval = retry_interval
+        self.outbox = deque()
+        self.in_flight = OrderedDict()
+        self.delivery_tag = 0
+        self.connection = None
+        self.channel = None
+        self.ready = False
+        self._stop_event = threading.Event()
+
+    def publish(self, exchange, routing_key, body, properties):
+        delivery = Delivery(exchange, routing_key, body, properties)
+        self.outbox.append(delivery)
+        self._wakeup()
+        return delivery.future
+
+    def stop(self):
+        self._stop_event.set()
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close)
+            except:  # pylint: disable=W0702
+                pass
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.connection = pika.SelectConnection(
+                self.get_parameters(),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self.connection.ioloop.start()
+            if not self._stop_event.is_set():
+                logging.info("[ConfirmPublisher] Reconnecting in %s seconds", self.retry_interval)
+                time.sleep(self.retry_interval)
+        for delivery in list(self.in_flight.values()) + list(self.outbox):
+            if not delivery.future.done():
+                delivery.future.set_exception(DeliveryError("Publisher stopped"))
+
+    def _wakeup(self):
+        connection = self.connection
+        if connection is None or not self.ready:
+            return  # pending messages are flushed once channel is ready
+        try:
+            connection.ioloop.add_callback_threadsafe(self._flush)
+        except:  # pylint: disable=W0702
+            pass
+
+    def _close(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        logging.info("[ConfirmPublisher] Connection failed: %s", error)
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self.ready = False
+        self.channel = None
+        # everything not confirmed yet goes out again with new delivery tags
+        self.outbox.extendleft(reversed(list(self.in_flight.values())))
+        self.in_flight.clear()
+        self.delivery_tag = 0
+        if not self._stop_event.is_set():
+            logging.info("[ConfirmPublisher] Connection closed: %s", reason)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirmation, callback=self._on_confirm_ok)
+
+    def _on_channel_closed(self, channel, reason):
+        logging.info("[ConfirmPublisher] Channel closed: %s", reason)
+        if self.connection.is_open:
+            self.connection.close()
+
+    def _on_confirm_ok(self, frame):
+        _ = frame
+        self.ready = True
+        self._flush()
+
+    def _on_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        confirmed = []
+        if method.multiple:
+            while self.in_flight and next(iter(self.in_flight)) <= method.delivery_tag:
+                confirmed.append(self.in_flight.popitem(last=False)[1])
+        elif method.delivery_tag in self.in_flight:
+            confirmed.append(self.in_flight.pop(method.delivery_tag))
+        for delivery in confirmed:
+            if acked:
+                delivery.future.set_result(True)
+            elif delivery.attempts <= self.max_retries:
+                logging.info("[ConfirmPublisher] Message nacked, retrying")
+                self.outbox.appendleft(delivery)
+            else:
+                delivery.future.set_exception(DeliveryError("Message was nacked by broker"))
+        self._flush()
+
+    def _flush(self):
+        while self.ready and self.outbox and len(self.in_flight) < self.max_in_flight:
+            delivery = self.outbox.popleft()
+            delivery.attempts += 1
+            self.delivery_tag += 1
+            self.in_flight[self.delivery_tag] = delivery
+            self.channel.basic_publish(
+                exchange=delivery.exchange, routing_key=delivery.routing_key,
+                body=delivery.body, properties=delivery.properties
+            )
@@ -0,0 +1,87 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import logging
+import math
+
+DELAY_QUEUE_EXPIRES = 60000  # ms, idle delay queue is deleted by broker after that
+# sec, delays are rounded up to these, each step is at most 1.5 times the previous one
+DELAY_BUCKETS = (
+    0.1, 0.25, 0.5, 1, 2, 3, 5, 7, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 450, 600, 900, 1200, 1800, 2700,
+    3600, 5400, 7200, 10800, 14400, 21600, 28800, 43200, 64800, 86400,
+)
+
+
+def delay_bucket(delay):
+    """ Delay rounded up to a bucket, so there is a bounded number of delay queues per target """
+    for bucket in DELAY_BUCKETS:
+        if delay <= bucket:
+            return bucket
+    return math.ceil(delay / DELAY_BUCKETS[-1]) * DELAY_BUCKETS[-1]
+
+
+def delay_queue(target, delay):
+    """
+    Name and arguments of the queue keeping messages for `delay` seconds (rounded up to a bucket)
+    before they are dead-lettered into target queue; one queue per bucket, so messages never wait
+    behind longer delays
+    """
+    delay_ms = int(delay_bucket(delay) * 1000)
+    return f"{target}.delay.{delay_ms}", {
+        "x-message-ttl": delay_ms,
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": target,
+        "x-expires": delay_ms + DELAY_QUEUE_EXPIRES,
+    }
+
+
+def declare_delay_queue(channel, target, delay):
+    """ Declare delay queue for target, returns routing key to publish delayed message with """
+    name, arguments = delay_queue(target, delay)
+    channel.queue_declare(queue=name, durable=True, arguments=arguments)
+    return name
+
+
+def move_messages(channel, source, target):
+    """ Move all messages between queues, each one is acked only after broker confirmed its copy """
+    moved = 0
+    while True:
+        method, properties, body = channel.basic_get(queue=source)
+        if method is None:
+            return moved
+        channel.basic_publish(exchange="", routing_key=target, body=body, properties=properties)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        moved += 1
+
+
+def migrate_queue(channel, queue, arguments=None):
+    """
+    Durable queue arguments can not be changed in place: messages are moved to a temporary
+    queue, queue is redeclared with new arguments and messages are moved back
+    Publishers (arbiters) have to be stopped as well as consumers: default exchange drops messages
+    published while the queue does not exist. Queue is deleted only if empty, so messages published
+    after it was drained fail the migration (PRECONDITION_FAILED) instead of being lost, moved ones
+    stay in the temporary queue and are picked up by the next run
+    """
+    channel.confirm_delivery()
+    temporary = f"{queue}.migration"
+    channel.queue_declare(queue=temporary, durable=True)
+    moved = move_messages(channel, queue, temporary)
+    channel.queue_delete(queue=queue, if_empty=True)
+    channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+    move_messages(channel, temporary, queue)
+    channel.queue_delete(queue=temporary)
+    logging.info("Queue %s redeclared with %s, %s messages moved", queue, arguments, moved)
+    return moved
@@ -0,0 +1,100 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import threading
+from time import time
+
+
+def capacity_message(state, message_type="heartbeat"):
+    """ Minion capacity snapshot, state is the dict shared by Minion handlers """
+    with state["lock"]:
+        return {
+            "type": message_type,
+            "minion_id": state["minion_id"],
+            "queue": state["queue"],
+            "active": state["active_workers"],
+            "total": state["total_workers"],
+            "available": state["total_workers"] - state["active_workers"],
+            "seq": state["seq"],
+            "interval": state["heartbeat_interval"],
+        }
+
+
+def change_active_workers(state, delta):
+    with state["lock"]:
+        state["active_workers"] += delta
+        state["seq"] += 1
+
+
+class WorkerRegistry:
+    """ Live minions capacity built from heartbeats, entries expire when heartbeats stop """
+
+    def __init__(self, missed_heartbeats=3):
+        self.missed_heartbeats = missed_heartbeats
+        self.lock = threading.Lock()
+        self.minions = dict()
+        self.legacy = dict()  # replies of minions without heartbeat support, summed per queue
+
+    def update(self, message):
+        now = time()
+        minion_id = message["minion_id"]
+        with self.lock:
+            record = self.minions.get(minion_id)
+            if record and message.get("seq", 0) < record["seq"]:
+                record["expires"] = self._expires(message, now)
+                return
+            self.minions[minion_id] = {
+                "queue": message["queue"],
+                "total": message["total"],
+                "active": message["active"],
+                "available": message["available"],
+                "seq": message.get("seq", 0),
+                "last_seen": now,
+                "expires": self._expires(message, now),
+            }
+
+    def update_legacy(self, message):
+        with self.lock:
+            queue = self.legacy.setdefault(message["queue"], {"total": 0, "active": 0, "available": 0})
+            for key in queue:
+                queue[key] += message.get(key, 0)
+
+    def _expires(self, message, now):
+        return now + (message.get("interval") or 2.0) * self.missed_heartbeats
+
+    def _expire(self, now):
+        for minion_id in [key for key, value in self.minions.items() if value["expires"] < now]:
+            self.minions.pop(minion_id)
+
+    def minion_ids(self):
+        with self.lock:
+            self._expire(time())
+            return list(self.minions.keys())
+
+    def workers(self):
+        """ Capacity aggregated per queue """
+        result = dict()
+        with self.lock:
+            self._expire(time())
+            for value in self.minions.values():
+                if value["queue"] not in result:
+                    result[value["queue"]] = {"total": 0, "active": 0, "available": 0,
+                                              "minions": 0, "last_seen": 0}
+                queue = result[value["queue"]]
+                for key in ["total", "active", "available"]:
+                    queue[key] += value[key]
+                queue["minions"] += 1
+                queue["last_seen"] = max(queue["last_seen"], value["last_seen"])
+        return result
@@ -0,0 +1,191 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import queue
+import logging
+import threading
+
+FINISHED_STATES = ("done", "exception")
+STREAM_END = object()
+STREAM_WINDOW = 16
+
+
+class AsyncResult:
+    """ Handle for a single task result, resolved by ArbiterEventHandler """
+
+    def __init__(self, task_key, state=None):
+        self.task_key = task_key
+        self.state = state if state is not None else {}
+        self.delivery = None  # Future resolved on broker ack when Arbiter runs with confirm=True
+        self.chunks = None  # queue of streamed chunks, for tasks applied with stream
+        self.stream_window = None
+        self.stream_reply_to = None  # queue of minion running streamed task, for credit
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        return self.ready() and self.state.get("state") == "done"
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError(f"Task {self.task_key} is not done after {timeout} sec")
+        if self.state.get("state") == "exception":
+            raise ChildProcessError(self.state.get("result"))
+        return self.state.get("result")
+
+    def add_done_callback(self, callback):
+        """ Callback is called with this handle once task is done (in handler thread) """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def _resolve(self, state):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.state = state
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self.chunks is not None:
+            self.chunks.put(STREAM_END)
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except:  # pylint: disable=W0702
+            logging.exception("[AsyncResult] Done callback failed for %s", self.task_key)
+
+    def __repr__(self):
+        return f"<AsyncResult {self.task_key} {self.state.get('state', 'initiated')}>"
+
+
+class ResultRegistry:
+    """ Task key -> AsyncResult mapping shared between Base and its event handlers """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handles = dict()
+
+    def register(self, task_key, state=None):
+        with self.lock:
+            if task_key not in self.handles:
+                self.handles[task_key] = AsyncResult(task_key, state)
+            return self.handles[task_key]
+
+    def get(self, task_key):
+        with self.lock:
+            return self.handles.get(task_key)
+
+    def discard(self, task_key):
+        with self.lock:
+            return self.handles.pop(task_key, None)
+
+    def forget(self, task_keys):
+        with self.lock:
+            for task_key in task_keys:
+                self.handles.pop(task_key, None)
+
+    def push_chunk(self, task_key, chunk, reply_to=None):
+        handle = self.get(task_key)
+        if handle is not None and handle.chunks is not None:
+            if reply_to:
+                handle.stream_reply_to = reply_to
+            handle.chunks.put(chunk)
+
+    def resolve(self, task_key, state):
+        handle = self.register(task_key, state)
+        handle._resolve(state)  # pylint: disable=W0212
+
+    def as_completed(self, task_keys, timeout=None):
+        """ Yield handles in the order tasks are done, blocking without polling """
+        done = queue.Queue()
+        handles = [self.register(task_key) for task_key in dict.fromkeys(task_keys)]
+        for handle in handles:
+            handle.add_done_callback(done.put)
+        for _ in handles:
+            try:
+                yield done.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"Tasks are not done after {timeout} sec")
+
+
+class ResultSet:
+    """ Set of AsyncResult handles, done once every one of them is done """
+
+    def __init__(self, handles):
+        self.handles = list(handles)
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._remaining = len(self.handles)
+        if not self.handles:
+            self._event.set()
+        for handle in self.handles:
+            handle.add_done_callback(self._on_done)
+
+    @property
+    def pending(self):
+        """ Keys of tasks that are not done yet """
+        return [handle.task_key for handle in self.handles if not handle.ready()]
+
+    def ready(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError(f"Tasks {self.pending} are not done after {timeout} sec")
+        return [handle.get() for handle in self.handles]
+
+    def add_done_callback(self, callback):
+        """ Callback is called with this set once all tasks are done """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def _on_done(self, handle):
+        _ = handle
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining:
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except:  # pylint: disable=W0702
+            logging.exception("[ResultSet] Done callback failed")
+
+    def __repr__(self):
+        return f"<ResultSet {len(self.handles) - len(self.pending)}/{len(self.handles)} done>"
@@ -0,0 +1,348 @@
+#   Copyright 2020 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import sys
+import threading
+from time import time
+from itertools import islice
+from collections import OrderedDict
+
+from arbiter.blobs import BlobRef
+from arbiter.result import FINISHED_STATES
+
+MISSING = object()
+
+
+class TaskRecord:
+    """ Compact per-task state, readable as a dict with task_type/state/result keys """
+    __slots__ = ("task_type", "state", "result", "group_id")
+    KEYS = ("task_type", "state", "result")
+
+    def __init__(self, task_type=None, state=None):
+        self.task_type = task_type
+        self.state = state
+        self.result = MISSING
+        self.group_id = None
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def keys(self):
+        return [key for key in self.KEYS if self._is_set(getattr(self, key))]
+
+    def __getitem__(self, key):
+        if key not in self.KEYS or not self._is_set(getattr(self, key)):
+            raise KeyError(key)
+        if key == "result" and isinstance(self.result, BlobRef):
+            return self.result.load()  # large results are loaded on first access, ref keeps the value
+        return getattr(self, key)
+
+    @staticmethod
+    def _is_set(value):
+        return value is not None and value is not MISSING
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class GroupRecord:
+    __slots__ = ("members", "unfinished", "sealed", "counters")
+
+    def __init__(self):
+        self.members = dict()  # ordered set of task keys
+        self.unfinished = 0
+        self.sealed = False
+        self.counters = {"initiated": 0, "running": 0, "done": 0, "exception": 0}
+
+    def count(self, state, delta):
+        if state is not None:
+            self.counters[state] = self.counters.get(state, 0) + delta
+
+    def status(self):
+        if self.counters["running"]:
+            state = "running"
+        elif self.counters["initiated"]:
+            state = "initiated"
+        elif not self.sealed:
+            state = "running"  # e.g. pipe between stages
+        else:
+            state = "done"
+        return dict(self.counters, state=state, total=len(self.members))
+
+
+class StateStore:
+    """
+    Arbiter state of tasks and groups
+
+    Subclass it to keep state elsewhere; on_evict callbacks are called with the keys
+    of every task dropped from the store
+    """
+
+    def __init__(self):
+        self.on_evict = []
+
+    def add_task(self, task_key, task_type="task"):
+        raise NotImplementedError
+
+    def update_task(self, task_key, state=None, result=MISSING):
+        """ Set task state/result, returns TaskRecord """
+        raise NotImplementedError
+
+    def get(self, task_key, default=None):
+        raise NotImplementedError
+
+    def __contains__(self, task_key):
+        return self.get(task_key) is not None
+
+    def add_group(self, group_id):
+        raise NotImplementedError
+
+    def add_to_group(self, group_id, task_key):
+        raise NotImplementedError
+
+    def seal_group(self, group_id):
+        """ No more members will be added, group can be evicted once finished """
+        raise NotImplementedError
+
+    def has_group(self, group_id):
+        raise NotImplementedError
+
+    def group_members(self, group_id):
+        raise NotImplementedError
+
+    def group_status(self, group_id):
+        """ Group state and per-state task counters """
+        raise NotImplementedError
+
+    def group_tasks(self, group_id, offset=0, limit=None):
+        """ Page of (task key, TaskRecord) pairs of group members """
+        raise NotImplementedError
+
+    def forget(self, key):
+        """ Drop task or group (with its members), returns True if something was dropped """
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def _evicted(self, task_keys):
+        for callback in self.on_evict:
+            callback(task_keys)
+
+
+class MemoryStateStore(StateStore):
+    """
+    In-memory state with eviction of finished tasks and groups
+
+    Finished ungrouped tasks and finished sealed groups are kept in LRU order and dropped
+    when not accessed for ttl seconds or when there are more than max_finished of them.
+    Running tasks and members of live groups are never evicted
+    """
+
+    def __init__(self, ttl=3600, max_finished=10000):
+        super().__init__()
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.lock = threading.RLock()
+        self.tasks = dict()
+        self.groups = dict()
+        self.finished = OrderedDict()  # task key or group id -> last access time
+        self.result_bytes = 0
+        self.evicted = 0
+
+    def add_task(self, task_key, task_type="task"):
+        with self.lock:
+            if task_key not in self.tasks:
+                self.tasks[task_key] = TaskRecord(task_type, "initiated")
+            return self.tasks[task_key]
+
+    def update_task(self, task_key, state=None, result=MISSING):
+        with self.lock:
+            record = self.tasks.get(task_key)
+            if record is None:
+                record = self.tasks[task_key] = TaskRecord()
+            was_finished = record.finished
+            if state is not None and state != record.state:
+                group = self.groups.get(record.group_id)
+                if group is not None:
+                    group.count(record.state, -1)
+                    group.count(state, 1)
+                record.state = state
+            if result is not MISSING:
+                self._set_result(record, result)
+            if record.finished and not was_finished:
+                self._task_finished(task_key, record)
+            return record
+
+    def get(self, task_key, default=None):
+        with self.lock:
+            record = self.tasks.get(task_key)
+            if record is None:
+                return default
+            self._touch(record.group_id or task_key)
+            return record
+
+    def add_group(self, group_id):
+        with self.lock:
+            self.groups[group_id] = GroupRecord()
+
+    def add_to_group(self, group_id, task_key):
+        with self.lock:
+            group = self.groups[group_id]
+            if task_key in group.members:
+                return
+            record = self.add_task(task_key)
+            record.group_id = group_id
+            self.finished.pop(task_key, None)
+            group.members[task_key] = None
+            group.count(record.state, 1)
+            if not record.finished:
+                group.unfinished += 1
+
+    def seal_group(self, group_id):
+        with self.lock:
+            group = self.groups.get(group_id)
+            if group is None or group.sealed:
+                return
+            group.sealed = True
+            if not group.unfinished:
+                self._mark_finished(group_id)
+
+    def has_group(self, group_id):
+        with self.lock:
+            if group_id not in self.groups:
+                return False
+            self._touch(group_id)
+            return True
+
+    def group_members(self, group_id):
+        with self.lock:
+            return list(self.groups[group_id].members)
+
+    def group_status(self, group_id):
+        with self.lock:
+            return self.groups[group_id].status()
+
+    def group_tasks(self, group_id, offset=0, limit=None):
+        with self.lock:
+            members = self.groups[group_id].members
+            stop = offset + limit if limit is not None else None
+            return [(task_key, self.tasks[task_key]) for task_key in islice(members, offset, stop)]
+
+    def forget(self, key):
+        with self.lock:
+            self.finished.pop(key, None)
+            if key in self.groups:
+                dropped = list(self.groups.pop(key).members)
+            elif key in self.tasks:
+                dropped = [key]
+                group_id = self.tasks[key].group_id
+                group = self.groups.get(group_id)
+                if group is not None:
+                    group.members.pop(key, None)
+                    group.count(self.tasks[key].state, -1)
+                    if not self.tasks[key].finished:
+                        group.unfinished -= 1
+                        if not group.unfinished and group.sealed:
+                            self.finished[group_id] = time()
+            else:
+                return False
+            for task_key in dropped:
+                self._drop_task(task_key)
+        self._evicted(dropped)
+        return True
+
+    def stats(self):
+        with self.lock:
+            dropped = self._evict()
+        if dropped:
+            self._evicted(dropped)
+        with self.lock:
+            return {
+                "tasks": len(self.tasks),
+                "groups": len(self.groups),
+                "finished": len(self.finished),
+                "evicted": self.evicted,
+                "result_bytes": self.result_bytes,
+                "approx_bytes": self.result_bytes + len(self.tasks) * sys.getsizeof(TaskRecord()) +
+                sum(sys.getsizeof(group.members) for group in self.groups.values()),
+            }
+
+    def _set_result(self, record, result):
+        if record.result is not MISSING:
+            self.result_bytes -= sys.getsizeof(record.result)
+        record.result = result
+        self.result_bytes += sys.getsizeof(result)
+
+    def _task_finished(self, task_key, record):
+        group = self.groups.get(record.group_id)
+        if group is None:
+            self._mark_finished(task_key)
+            return
+        group.unfinished -= 1
+        if not group.unfinished and group.sealed:
+            self._mark_finished(record.group_id)
+
+    def _mark_finished(self, key):
+        self.finished[key] = time()
+        self.finished.move_to_end(key)
+        dropped = self._evict()
+        if dropped:
+            self._evicted(dropped)
+
+    def _touch(self, key):
+        if key in self.finished:
+            self.finished[key] = time()
+            self.finished.move_to_end(key)
+
+    def _evict(self):
+        dropped = []
+        expired = time() - self.ttl
+        while self.finished:
+            key, accessed = next(iter(self.finished.items()))
+            if len(self.finished) <= self.max_finished and accessed >= expired:
+                break
+            self.finished.popitem(last=False)
+            self.evicted += 1
+            if key in self.groups:
+                members = list(self.groups.pop(key).members)
+            else:
+                members = [key]
+            for task_key in members:
+                self._drop_task(task_key)
+            dropped.extend(members)
+        return dropped
+
+    def _drop_task(self, task_key):
+        record = self.tasks.pop(task_key, None)
+        if record is not None and record.result is not MISSING:
+            self.result_bytes -= sys.getsizeof(record.result)
+            if isinstance(record.result, BlobRef) and not record.result.loaded:
+                record.result.discard()
@@ -17,7 +17,7 @@ from time import time
 
 class Task:
     def __init__(self, name, queue='default', tasks_count=1, task_key="", task_type="task",
-                 task_args=None, task_kwargs=None, callback=False, callback_queue=None, timeout=-1):
+                 task_args=None, task_kwargs=None, callback=False, callback_queue=None, timeout=-1, stream=None, priority=None):
         if not task_args:
             task_args = []
         if not task_kwargs:
@@ -33,7 +33,11 @@ class Task:
         self.callback_queue = callback_queue
         self.tasks_array = []  # this is for a task ids that need to be verified to be done before callback
         self.timeout = timeout  # timeout in seconds. Works only with task_type=finalize
-        self.start_time = int(time())
+        self.start_time = time()
+        self.stream = stream  # chunks of generator task streamed ahead of consumer, None - result is a list
+        self.priority = priority  # AMQP message priority, used when queue is declared with max_priority
+        self.chain = None  # messages of next pipe stages, minion sends its result straight to the first one
+        self.map = False  # args are items of Arbiter.map chunk, task is called with each of them
 
     def to_json(self):
         return {
@@ -47,5 +51,9 @@ class Task:
             "callback": self.callback,
             "tasks_array": self.tasks_array,
             "timeout": self.timeout,
-            "start_time": self.start_time
+            "start_time": self.start_time,
+            "stream": self.stream,
+            "priority": self.priority,
+            "chain": self.chain,
+            "map": self.map
         }
@@ -13,84 +13,107 @@
 #   limitations under the License.
 
 
-import pika
-import ssl
-from json import dumps
+import threading
+from functools import partial
 from uuid import uuid4
-from time import sleep
 
 from arbiter.config import Config
 from arbiter.event.process import ProcessEventHandler
+from arbiter.registry import WorkerRegistry
+
+
+class StateRequest:
+    """ Replies of minions to one task state query """
+
+    def __init__(self, tasks, minions):
+        self.tasks = set(tasks)
+        self.minions = minions  # live minions, registry keeps growing with state replies while request is pending
+        self.answered = set()
+        self.running = set()
+        self.done = set()
+        self.lock = threading.Lock()
+        self.complete = threading.Event()
+
+    def add(self, reply, minion_id=None):
+        with self.lock:
+            for key, value in reply.items():
+                if key in self.tasks:
+                    (self.running if value else self.done).add(key)
+            if minion_id:
+                self.answered.add(minion_id)
+            self._check()
+
+    def check(self):
+        """ Called when registry of live minions changed """
+        with self.lock:
+            self._check()
+
+    def _check(self):
+        expected = set(self.minions.minion_ids())
+        if self.tasks <= self.done or (expected and expected <= self.answered):
+            self.complete.set()
+
+    def result(self):
+        with self.lock:
+            return {"running": list(self.running), "done": list(self.done)}
 
 
 class ProcessWatcher:
+    """
+    Task state queries of group callbacks and finalizers, one per Minion
+    Connection is opened on first query and kept, replies are gathered on exclusive queue and
+    query returns once every live minion answered (or all tasks are done), wait_time is the limit
+    """
+
     def __init__(self, process_id, host, port, user, password, vhost="carrier", all_queue="arbiterAll",
-                 wait_time=2.0, use_ssl=False, ssl_verify=False):
-        self.config = Config(host, port, user, password, vhost, None, all_queue, use_ssl, ssl_verify)
-        self.connection = self._get_connection()
+                 wait_time=2.0, use_ssl=False, ssl_verify=False, codec=None):
+        self.config = Config(host, port, user, password, vhost, None, all_queue, use_ssl, ssl_verify, codec=codec)
         self.process_id = process_id
-        self.state = {}
+        self.state = {}  # request id -> StateRequest
         self.subscriptions = dict()
-        self.arbiter_id = str(uuid4())
-        self.handler = ProcessEventHandler(self.config, self.subscriptions, self.state, self.process_id)
-        self.handler.start()
-        self.handler.wait_running()
+        self.minions = WorkerRegistry()
+        self.handler = None
+        self.lock = threading.Lock()
         self.wait_time = wait_time
 
-    def _get_connection(self):  # This code duplication needed to avoid thread safeness problem of pika
-        ssl_options = None
-        #
-        if self.config.use_ssl:
-            ssl_context = ssl.create_default_context()
-            if self.config.ssl_verify:
-                ssl_context.verify_mode = ssl.CERT_REQUIRED
-                ssl_context.check_hostname = True
-                ssl_context.load_default_certs()
-            else:
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-            ssl_server_hostname = self.config.host
-            #
-            ssl_options = pika.SSLOptions(ssl_context, ssl_server_hostname)
-        #
-        _connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=self.config.host,
-                port=self.config.port,
-                virtual_host=self.config.vhost,
-                credentials=pika.PlainCredentials(
-                    self.config.user,
-                    self.config.password
-                ),
-                ssl_options=ssl_options,
-            )
+    def _get_handler(self):
+        with self.lock:
+            if self.handler is None or not self.handler.is_alive():
+                self.handler = ProcessEventHandler(self.config, self.subscriptions, self.state, self.process_id,
+                                                   self.minions)
+                self.handler.start()
+                self.handler.wait_running()
+                # capacity replies tell which minions are alive before their next heartbeat
+                self._publish(self.handler, {"type": "state", "arbiter": self.process_id}, exchange=self.config.all)
+            return self.handler
+
+    @staticmethod
+    def _publish(handler, msg, queue="", exchange=""):
+        # pika connection is not thread-safe, message is published by handler thread
+        handler.channel.connection.add_callback_threadsafe(
+            partial(handler.respond, handler.channel, msg, queue, exchange=exchange)
         )
-        channel = _connection.channel()
-        return channel
 
     def send_message(self, msg, queue="", exchange=""):
-        self._get_connection().basic_publish(
-            exchange=exchange, routing_key=queue,
-            body=dumps(msg).encode("utf-8"),
-            properties=pika.BasicProperties(
-                delivery_mode=2
-            )
-        )
+        self._publish(self._get_handler(), msg, queue, exchange)
 
     def collect_state(self, tasks):
-        if self.process_id not in self.state:
-            self.state[self.process_id] = {
-                "running": [],
-                "done": []
-            }
+        handler = self._get_handler()
+        request_id = str(uuid4())
+        request = StateRequest(tasks, self.minions)
+        self.state[request_id] = request
         message = {
             "type": "task_state",
             "tasks": tasks,
-            "arbiter": self.process_id
+            "arbiter": self.process_id,
+            "request_id": request_id
         }
-        self.send_message(message, exchange=self.config.all)
-        sleep(self.wait_time)
-        return self.state.get(self.process_id, {})
+        try:
+            self._publish(handler, message, exchange=self.config.all)
+            request.complete.wait(self.wait_time)
+        finally:
+            self.state.pop(request_id, None)
+        return request.result()
 
     def clear_state(self, tasks):
         message = {
@@ -99,9 +122,14 @@ class ProcessWatcher:
             "arbiter": self.process_id
         }
         self.send_message(message, exchange=self.config.all)
-        sleep(self.wait_time)
 
     def close(self):
-        self.handler.stop()
-        self._get_connection().queue_delete(queue=self.process_id)
-        self.handler.join()
+        with self.lock:
+            handler, self.handler = self.handler, None
+        if handler is None:
+            return
+        handler.stop()
+        if handler.channel is not None and handler.channel.is_open:
+            handler.channel.connection.add_callback_threadsafe(handler.channel.stop_consuming)
+            handler.join()
+            handler.channel.connection.close()  # exclusive queues go away with it
@@ -1,9 +1,11 @@
 from arbiter import Minion
 from multiprocessing import Process
-from time import sleep
+from time import sleep, time
 import logging
 
 app = Minion(host="localhost", port=5672, user='user', password='password', queue="default")
+priority_app = Minion(host="localhost", port=5672, user='user', password='password', queue="priority",
+                      max_priority=10)
 
 
 @app.task(name="add")
@@ -32,21 +34,55 @@ def addp(x, y, upstream=0):
     return x + y + upstream
 
 
+@app.task(name="sum_upstream")
+def sum_upstream(x, upstream=None):
+    return x + sum((upstream or {}).values())
+
+
+@app.task(name="square")
+def square(x):
+    return x * x
+
+
+@app.task(name="unencodable")
+def unencodable():
+    return {1, 2}  # JSON can not encode a set
+
+
+@app.task(name="count_to")
+def count_to(n):
+    for i in range(n):
+        yield i
+
+
 @app.task(name="long_running")
 def long_task():
     sleep(180)
     return "Long Task"
 
 
-def run(rpc):
+@priority_app.task(name="timestamp")
+def timestamp(duration=0):
+    sleep(duration)
+    return time()
+
+
+def run(rpc, **options):
     if rpc:
         app.rpc(workers=1, blocking=True)
     else:
-        app.run(workers=10)
+        app.run(workers=10, **options)
+
+
+def start_minion(rpc: bool = False, **options) -> Process:
+    p = Process(target=run, args=(rpc,), kwargs=options)
+    p.start()
+    sleep(5)  # some time to start Minion
+    return p
 
 
-def start_minion(rpc: bool = False) -> Process:
-    p = Process(target=run, args=(rpc,))
+def start_priority_minion() -> Process:
+    p = Process(target=priority_app.run, kwargs={"workers": 1})
     p.start()
     sleep(5)  # some time to start Minion
     return p
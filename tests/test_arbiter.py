@@ -1,8 +1,10 @@
 import pytest
+import asyncio
 
 from time import sleep, time
 from arbiter import Arbiter, Task
-from tests.minion import stop_minion, start_minion
+from arbiter.aio import AsyncArbiter, AsyncMinion
+from tests.minion import stop_minion, start_minion, start_priority_minion
 
 arbiter_host = "localhost"
 arbiter_user = "user"
@@ -39,6 +41,96 @@ class TestArbiter:
         assert arbiter.workers()[arbiter_queue]['available'] == 10
         arbiter.close()
 
+    @staticmethod
+    def test_apply_async():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        results = arbiter.apply_async("simple_add", tasks_count=2, task_args=[1, 2])
+        for result in results:
+            assert result.get(timeout=60) == 3
+            assert result.ready()
+        arbiter.close()
+
+    @staticmethod
+    def test_apply_with_confirms():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password, confirm=True)
+        results = arbiter.apply_async("simple_add", tasks_count=2, task_args=[1, 2])
+        for result in results:
+            result.delivery.result(timeout=10)  # broker acked the publish
+            assert result.get(timeout=60) == 3
+        arbiter.close()
+
+    @staticmethod
+    def test_unencodable_result():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        result = arbiter.apply_async("unencodable")[0]
+        with pytest.raises(ChildProcessError):
+            result.get(timeout=60)
+        assert arbiter.status(result.task_key)["state"] == "exception"
+        assert arbiter.workers()[arbiter_queue]["available"] == 10
+        arbiter.close()
+
+    @staticmethod
+    def test_stream():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        task_key = arbiter.apply("count_to", task_args=[50], stream=4)[0]
+        assert list(arbiter.stream(task_key, timeout=60)) == list(range(50))
+        assert arbiter.status(task_key)['state'] == 'done'
+        task_key, message = arbiter.apply("count_to", task_args=[3], sync=True)
+        assert message["result"] == [0, 1, 2]
+        assert arbiter.status(task_key)["result"] == [0, 1, 2]
+        arbiter.close()
+
+    @staticmethod
+    def test_async_arbiter():
+        async def run():
+            async with AsyncArbiter(host=arbiter_host, port=5672, user=arbiter_user,
+                                    password=arbiter_password) as arbiter:
+                task_keys = await arbiter.apply("simple_add", tasks_count=2, task_args=[1, 2])
+                assert [await arbiter.get(task_key, timeout=60) for task_key in task_keys] == [3, 3]
+                assert arbiter.status(task_keys[0])['state'] == 'done'
+        asyncio.run(run())
+
+    @staticmethod
+    def test_async_kill_group_with_callback():
+        async def run():
+            async with AsyncArbiter(host=arbiter_host, port=5672, user=arbiter_user,
+                                    password=arbiter_password) as arbiter:
+                group_id = await arbiter.group([Task("long_running")], callback=Task("simple_add", task_args=[1, 2]))
+                await asyncio.sleep(5)  # time for group to settle
+                assert await arbiter.kill_group(group_id, timeout=60)
+                tasks = arbiter.group_tasks(group_id)
+                assert [each["result"] for each in tasks] == ["canceled", "canceled"]
+                await asyncio.sleep(1)
+                assert not arbiter.followers
+        asyncio.run(run())
+
+    @staticmethod
+    def test_async_minion():
+        async def run():
+            app = AsyncMinion(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password,
+                              queue="async_minion")
+
+            @app.task(name="async_add")
+            async def async_add(x, y):
+                await asyncio.sleep(0.1)
+                return x + y
+
+            @app.task(name="sync_add")
+            def sync_add(x, y):
+                return x + y
+
+            minion = asyncio.create_task(app.run(concurrency=10))
+            await asyncio.sleep(1)  # some time to start AsyncMinion
+            async with AsyncArbiter(host=arbiter_host, port=5672, user=arbiter_user,
+                                    password=arbiter_password) as arbiter:
+                task_keys = await arbiter.apply("async_add", queue="async_minion", tasks_count=20, task_args=[1, 2])
+                sync_keys = await arbiter.apply("sync_add", queue="async_minion", task_args=[2, 3])
+                assert [await arbiter.get(task_key, timeout=60) for task_key in task_keys] == [3] * 20
+                assert await arbiter.get(sync_keys[0], timeout=60) == 5
+            await app.close()
+            await minion
+        asyncio.run(run())
+
     @staticmethod
     def test_squad():
         tasks_in_squad = 3
@@ -51,7 +143,7 @@ class TestArbiter:
             sleep(1)
         status = arbiter.status(squad_id)
         assert status["done"] == tasks_in_squad
-        assert len(status["tasks"]) == tasks_in_squad
+        assert len(arbiter.group_tasks(squad_id)) == tasks_in_squad
         assert arbiter.workers()[arbiter_queue]['available'] == 10
         arbiter.close()
 
@@ -74,10 +166,40 @@ class TestArbiter:
                 _loop_id += 1
         status = arbiter.status(pipe_id)
         assert status["done"] == tasks_in_pipe
-        assert len(status["tasks"]) == tasks_in_pipe
+        assert len(arbiter.group_tasks(pipe_id)) == tasks_in_pipe
         assert arbiter.workers()[arbiter_queue]['available'] == 10
         arbiter.close()
 
+    @staticmethod
+    def test_dag():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        tasks = {name: Task("sum_upstream", task_args=[x]) for name, x in [("a", 1), ("b", 2), ("c", 3), ("d", 4)]}
+        dag_id = arbiter.dag(tasks, {"b": ["a"], "c": ["a"], "d": ["b", "c"]})
+        assert arbiter.async_result(tasks["d"].task_key).get(timeout=60) == 11
+        assert arbiter.status(dag_id)["done"] == 4
+        assert [each["result"] for each in arbiter.group_tasks(dag_id)] == [1, 3, 4, 11]
+        arbiter.close()
+
+    @staticmethod
+    def test_chained_pipe():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        tasks = [Task("add_in_pipe", task_args=[2]) for _ in range(5)]
+        messages = list(arbiter.pipe(tasks, persistent_args=[2], chained=True))
+        pipe_id = messages[0]["pipe_id"]
+        assert [message["state"] for message in messages[1:]] == ["done"] * 5
+        assert messages[-1]["result"] == 20
+        assert arbiter.status(pipe_id)["done"] == 5
+        arbiter.close()
+
+    @staticmethod
+    def test_map():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        assert list(arbiter.map("square", range(1000), chunksize=50, timeout=60)) == [x * x for x in range(1000)]
+        results = arbiter.map("square", iter(range(100)), chunksize=7, ordered=False, timeout=60)
+        assert sorted(results) == [x * x for x in range(100)]
+        assert arbiter.stats()["tasks"] == 0
+        arbiter.close()
+
     @staticmethod
     def test_kill_task():
         arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
@@ -103,7 +225,7 @@ class TestArbiter:
             tasks.append(Task("long_running"))
         squad_id = arbiter.squad(tasks)
         sleep(5)  # time for squad to settle
-        arbiter.kill_group(squad_id)
+        assert not arbiter.kill_group(squad_id, timeout=60).pending
         while arbiter.status(squad_id).get("state") != "done":
             sleep(1)
         assert time() - start < 180
@@ -122,9 +244,10 @@ class TestArbiter:
             sleep(1)
         status = arbiter.status(squad_id)
         assert status["done"] == tasks_in_squad + 1
-        assert len(status["tasks"]) == tasks_in_squad + 1
-        assert status["tasks"][-1]['task_type'] == "callback"
-        assert status["tasks"][-1]['result'] == 9
+        tasks = arbiter.group_tasks(squad_id)
+        assert len(tasks) == tasks_in_squad + 1
+        assert tasks[-1]['task_type'] == "callback"
+        assert tasks[-1]['result'] == 9
         assert arbiter.workers()[arbiter_queue]['available'] == 10
         arbiter.close()
 
@@ -141,12 +264,38 @@ class TestArbiter:
             sleep(1)
         status = arbiter.status(squad_id)
         assert status["done"] == tasks_in_squad + 2  # callback + finalizer
-        assert len(status["tasks"]) == tasks_in_squad + 2  # callback + finalizer
-        assert status["tasks"][-1]['task_type'] == "finalize"
-        assert status["tasks"][-1]['result'] == 10
+        tasks = arbiter.group_tasks(squad_id)
+        assert len(tasks) == tasks_in_squad + 2  # callback + finalizer
+        assert tasks[-1]['task_type'] == "finalize"
+        assert tasks[-1]['result'] == 10
         assert arbiter.workers()[arbiter_queue]['available'] == 10
         arbiter.close()
 
+    @staticmethod
+    def test_finalizer_timeout():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        start = time()
+        group_id = arbiter.group([Task("long_running"), Task("square", task_args=[2], task_type="finalize", timeout=5)])
+        finalizer = [each for each in arbiter.group_tasks(group_id) if each["task_type"] == "finalize"][0]
+        assert arbiter.async_result(finalizer["task_key"]).get(timeout=60) == 4
+        assert time() - start < 60  # long_running takes 180 sec
+        assert arbiter.status(group_id).get("state") != "done"
+        assert not arbiter.kill_group(group_id, timeout=60).pending
+        arbiter.close()
+
+    @staticmethod
+    def test_countdown_and_eta():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        start = time()
+        delayed = arbiter.apply_async("square", task_args=[3], countdown=3)[0]
+        scheduled = arbiter.apply_async("square", task_args=[4], eta=start + 3)[0]
+        sleep(1)
+        assert arbiter.status(delayed.task_key)["state"] == "initiated"  # still held by broker
+        assert delayed.get(timeout=60) == 9
+        assert scheduled.get(timeout=60) == 16
+        assert time() - start >= 3
+        arbiter.close()
+
     @staticmethod
     def test_sync_task():
         arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
@@ -155,3 +304,60 @@ class TestArbiter:
                 assert result['state'] == 'done'
                 assert result['result'] == 3
         assert arbiter.workers()[arbiter_queue]['available'] == 10
+
+
+class TestPrefetch:
+    p = None
+
+    @classmethod
+    def setup_class(cls):
+        cls.p = start_minion(prefetch=5)
+
+    @classmethod
+    def teardown_class(cls):
+        stop_minion(cls.p)
+
+    @staticmethod
+    def test_prefetched_tasks_run_concurrently():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        start = time()
+        results = arbiter.apply_async("simple_add", tasks_count=10, task_args=[1, 2])
+        assert [result.get(timeout=60) for result in results] == [3] * 10
+        assert time() - start < 20  # one round of 10 sec tasks, not one task per consumer at a time
+        assert arbiter.workers()[arbiter_queue]["available"] == 10
+        arbiter.close()
+
+    @staticmethod
+    def test_unencodable_result_with_prefetch():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        failed = arbiter.apply_async("unencodable")[0]
+        results = arbiter.apply_async("simple_add", tasks_count=4, task_args=[1, 2])
+        with pytest.raises(ChildProcessError):
+            failed.get(timeout=60)
+        # failed report does not hold prefetched tasks of the same consumer
+        assert [result.get(timeout=60) for result in results] == [3] * 4
+        assert arbiter.workers()[arbiter_queue]["available"] == 10
+        arbiter.close()
+
+
+class TestPriority:
+    p = None
+
+    @classmethod
+    def setup_class(cls):
+        cls.p = start_priority_minion()
+
+    @classmethod
+    def teardown_class(cls):
+        stop_minion(cls.p)
+
+    @staticmethod
+    def test_priority_task_runs_before_queued_ones():
+        arbiter = Arbiter(host=arbiter_host, port=5672, user=arbiter_user, password=arbiter_password)
+        arbiter.apply("timestamp", queue="priority", task_kwargs={"duration": 3})
+        sleep(1)  # the only worker is busy, next tasks wait in the queue
+        queued = arbiter.apply_async("timestamp", queue="priority", tasks_count=3)
+        urgent = arbiter.apply_async("timestamp", queue="priority", priority=9)[0]
+        finished = urgent.get(timeout=60)
+        assert all(finished < result.get(timeout=60) for result in queued)
+        arbiter.close()
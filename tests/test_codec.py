@@ -0,0 +1,29 @@
+import pika
+import pytest
+
+from arbiter.codec import JsonCodec, codec_for, get_codec, properties_for
+
+MESSAGE = {"type": "task", "task_key": "key", "args": [1, 2.5, "three", None], "kwargs": {"flag": True}}
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgpack"])
+def test_round_trip(name):
+    if name != "json":
+        pytest.importorskip(name)
+    codec = get_codec(name)
+    body = codec.encode(MESSAGE)
+    assert isinstance(body, bytes)
+    assert codec.decode(body) == MESSAGE
+    properties = pika.BasicProperties(**properties_for(codec))
+    assert codec_for(properties).decode(body) == MESSAGE
+
+
+def test_codec_is_picked_by_content_type():
+    pytest.importorskip("msgpack")
+    msgpack_codec = get_codec("msgpack")
+    properties = pika.BasicProperties(**properties_for(msgpack_codec))
+    # local codec is used for replies, message itself is decoded by its content type
+    assert codec_for(properties, JsonCodec) is msgpack_codec
+    assert codec_for(pika.BasicProperties(), msgpack_codec) is JsonCodec  # older peers send no content type
+    with pytest.raises(ValueError):
+        codec_for(pika.BasicProperties(content_type="application/xml"))
@@ -0,0 +1,105 @@
+import threading
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from arbiter.codec import JsonCodec, properties_for
+from arbiter.event.broadcast import GlobalEventHandler
+from arbiter.executor import CancelledTask, InlineExecutor, ProcessExecutor, ThreadExecutor
+
+started = threading.Event()
+released = threading.Event()
+
+
+def square(x):
+    return x * x
+
+
+def count_to(n):
+    for i in range(n):
+        yield i
+
+
+def fail():
+    raise ValueError("task failed")
+
+
+def blocked():
+    started.set()
+    released.wait(30)
+    return "released"
+
+
+def test_forkserver_process_executor():
+    executor = ProcessExecutor(2, {"square": square, "count_to": count_to}, max_tasks_per_child=2,
+                               start_method="forkserver")
+    try:
+        assert executor.modules == [__name__]  # preloaded into fork server
+        handles = [executor.submit(square, [x]) for x in range(6)]  # workers are replaced on the way
+        assert [handle.get(timeout=60) for handle in handles] == [x * x for x in range(6)]
+        chunks = []
+        handle = executor.submit(count_to, [5], on_chunk=chunks.append, window=2)
+        handle.grant(5)  # credit is waited for before the generator is advanced, also for its end
+        handle.get(timeout=60)
+        assert chunks == [0, 1, 2, 3, 4]
+        with pytest.raises(ValueError):
+            executor.submit(fail).get(timeout=60)
+    finally:
+        executor.close()
+
+
+def test_thread_executor():
+    executor = ThreadExecutor(1)
+    try:
+        assert executor.submit(square, [3]).get(timeout=10) == 9
+        chunks = []
+        handle = executor.submit(count_to, [3], on_chunk=chunks.append, window=1)
+        assert not handle.wait(0.5)  # waits for credit after the first chunk
+        handle.grant(3)
+        handle.get(timeout=10)
+        assert chunks == [0, 1, 2]
+        running = executor.submit(blocked)
+        queued = executor.submit(square, [2])
+        assert started.wait(10)
+        assert queued.cancel()
+        assert queued.cancelled
+        with pytest.raises(CancelledTask):
+            queued.get(timeout=10)
+        assert not running.cancel()  # running thread can not be stopped
+        released.set()
+        assert running.get(timeout=10) == "released"
+    finally:
+        started.clear()
+        released.clear()
+        executor.close()
+
+
+def test_inline_executor():
+    executor = InlineExecutor()
+    handle = executor.submit(square, [4])
+    assert handle.ready()
+    assert handle.get() == 16
+    assert executor.submit(count_to, [3]).get() == [0, 1, 2]
+    with pytest.raises(ValueError):
+        executor.submit(fail).get()
+    assert not handle.cancel()
+
+
+def test_stop_task_the_executor_can_not_cancel():
+    executor = ThreadExecutor(1)
+    try:
+        process = executor.submit(blocked)
+        assert started.wait(10)
+        state = {"task": {"process": process, "status": "running"}}
+        handler = GlobalEventHandler(SimpleNamespace(codec=JsonCodec), {}, state)
+        properties = pika.BasicProperties(**properties_for(JsonCodec))
+        handler.queue_event_callback(None, None, properties, JsonCodec.encode({"type": "stop_task", "task_key": "task"}))
+        assert state["task"]["status"] == "running"
+        assert not process.cancelled
+        released.set()
+        assert process.get(timeout=10) == "released"
+    finally:
+        started.clear()
+        released.clear()
+        executor.close()
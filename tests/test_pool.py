@@ -0,0 +1,38 @@
+import threading
+from time import sleep
+
+from arbiter.pool import ChannelPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.is_open = True
+
+    def channel(self):
+        return self
+
+    def close(self):
+        self.is_open = False
+
+
+def test_waiters_get_slots_of_discarded_connections():
+    pool = ChannelPool(FakeConnection, max_size=2, check_interval=0)
+    held = [pool._checkout(), pool._checkout()]  # pylint: disable=W0212
+    done = []
+
+    def publish(index):
+        with pool.channel():
+            sleep(0.01)
+        done.append(index)
+
+    threads = [threading.Thread(target=publish, args=(index,), daemon=True) for index in range(5)]
+    for thread in threads:
+        thread.start()
+    sleep(0.1)
+    for item in held:  # broker restart, checked out connections are broken
+        item.connection.close()
+        pool._discard(item)  # pylint: disable=W0212
+    for thread in threads:
+        thread.join(5)
+    assert sorted(done) == list(range(5))
+    assert pool.size == 2
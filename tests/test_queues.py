@@ -0,0 +1,10 @@
+from arbiter.queues import DELAY_BUCKETS, delay_queue
+
+
+def test_delays_share_bucket_queues():
+    names = {delay_queue("default", delay / 10)[0] for delay in range(1, 36000)}
+    assert len(names) <= len(DELAY_BUCKETS)
+    name, arguments = delay_queue("default", 61.5)
+    assert name == "default.delay.90000"
+    assert arguments["x-message-ttl"] == 90000
+    assert delay_queue("default", 86400 * 3 + 1)[1]["x-message-ttl"] == 86400 * 4 * 1000
@@ -0,0 +1,35 @@
+from arbiter.blobs import BlobRef, FileBlobStore, offload
+from arbiter.codec import get_codec
+from arbiter.event.arbiter import apply_event
+from arbiter.result import ResultRegistry
+from arbiter.state import MemoryStateStore
+
+
+def test_blob_result_bytes(tmp_path):
+    store = FileBlobStore(str(tmp_path))
+    state = MemoryStateStore()
+    value = "x" * 100 * 1024
+    marker = offload(store, value, get_codec(), 1024)
+    state.add_task("task")
+    state.update_task("task", "done", BlobRef(store, marker))
+    stored = state.stats()["result_bytes"]
+    assert stored > 0
+    assert state.get("task")["result"] == value
+    assert state.get("task")["result"] == value
+    assert state.stats()["result_bytes"] == stored
+    assert state.forget("task")
+    assert state.stats()["result_bytes"] == 0
+
+
+def test_late_event_of_forgotten_task():
+    state = MemoryStateStore()
+    results = ResultRegistry()
+    state.on_evict.append(results.forget)
+    state.add_task("chunk")
+    results.register("chunk")
+    assert state.forget("chunk")
+    apply_event({"type": "task_state_change", "task_key": "chunk", "task_state": "done", "result": "x" * 8000},
+                state, results)
+    assert state.get("chunk") is None
+    assert results.get("chunk") is None
+    assert state.stats()["result_bytes"] == 0